@@ -2,32 +2,72 @@ import os
 import json
 import uuid
 import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict, Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 from datetime import datetime, timedelta
 import base64
+import sqlite3
+import random
+import bisect
+import hmac
+import cProfile
+from contextlib import contextmanager
 from urllib.parse import urljoin
 
 from flask import (Flask, render_template, request, redirect, url_for, flash,
-                   session, g, jsonify, abort)
+                   session, g, jsonify, abort, Response, has_request_context)
 from flask_login import (LoginManager, UserMixin, login_user, logout_user,
                          login_required, current_user)
 from sqlalchemy import (create_engine, MetaData, Table, Column, Integer, String,
                         Text, DateTime, Float, Boolean, ForeignKey, event, or_)
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import func, and_
+from sqlalchemy.orm import sessionmaker, scoped_session, declarative_base
 from sqlalchemy.engine import Engine
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-import fitz
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
+from document_render import render_document
 
 load_dotenv()
 
-# --- App Configuration & Database Setup (unchanged) ---
+# --- App Configuration & Database Setup ---
 app = Flask(__name__)
 app.config.from_mapping(SECRET_KEY=os.getenv('SECRET_KEY'), UPLOAD_FOLDER=os.getenv('UPLOAD_FOLDER'), MAX_CONTENT_LENGTH=int(os.getenv('MAX_CONTENT_LENGTH', 16)) * 1024 * 1024, SQLALCHEMY_DATABASE_URI=os.getenv('DATABASE_URL'), ADMIN_SIGNUP_SECRET=os.getenv('ADMIN_SIGNUP_SECRET'), LMSTUDIO_HOST=os.getenv('LMSTUDIO_HOST'), LMSTUDIO_API_KEY=os.getenv('LMSTUDIO_API_KEY'))
-Base = declarative_base(); engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI']); Session = sessionmaker(bind=engine); db_session = Session()
+app.config.from_mapping(MEDGEMMA_MODEL=os.getenv('MEDGEMMA_MODEL', 'medgemma-4b-it'), AI_CACHE_MAX_ENTRIES=int(os.getenv('AI_CACHE_MAX_ENTRIES', 512)), AI_CACHE_MAX_BYTES=int(os.getenv('AI_CACHE_MAX_BYTES', 8)) * 1024 * 1024, AI_CACHE_TTL=int(os.getenv('AI_CACHE_TTL', 7 * 24 * 3600)))
+app.config.from_mapping(MEDGEMMA_MAX_CONCURRENCY=int(os.getenv('MEDGEMMA_MAX_CONCURRENCY', 2)), JOB_STALE_AFTER=int(os.getenv('JOB_STALE_AFTER', 600)), MEDGEMMA_STREAM_WAIT=float(os.getenv('MEDGEMMA_STREAM_WAIT', 30)))
+app.config.from_mapping(LMSTUDIO_POOL_SIZE=int(os.getenv('LMSTUDIO_POOL_SIZE', 8)), LMSTUDIO_CONNECT_TIMEOUT=float(os.getenv('LMSTUDIO_CONNECT_TIMEOUT', 5)), LMSTUDIO_READ_TIMEOUT=float(os.getenv('LMSTUDIO_READ_TIMEOUT', 180)), LMSTUDIO_MAX_RETRIES=int(os.getenv('LMSTUDIO_MAX_RETRIES', 2)), LMSTUDIO_BREAKER_THRESHOLD=int(os.getenv('LMSTUDIO_BREAKER_THRESHOLD', 5)), LMSTUDIO_BREAKER_COOLDOWN=float(os.getenv('LMSTUDIO_BREAKER_COOLDOWN', 30)), LMSTUDIO_STRUCTURED_OUTPUT=os.getenv('LMSTUDIO_STRUCTURED_OUTPUT', 'true').lower() in ('1', 'true', 'yes'))
+app.config.from_mapping(DOCTOR_SEARCH_PAGE_SIZE=int(os.getenv('DOCTOR_SEARCH_PAGE_SIZE', 24)), DOCTOR_SEARCH_MIN_SIMILARITY=float(os.getenv('DOCTOR_SEARCH_MIN_SIMILARITY', 0.5)), DOCTOR_INDEX_REFRESH_INTERVAL=float(os.getenv('DOCTOR_INDEX_REFRESH_INTERVAL', 30)))
+app.config.from_mapping(RENDER_CACHE_FOLDER=os.getenv('RENDER_CACHE_FOLDER', 'render_cache'), PREPROCESS_WORKERS=int(os.getenv('PREPROCESS_WORKERS', 2)), PREPROCESS_MAX_SIDE=int(os.getenv('PREPROCESS_MAX_SIDE', 896)), PREPROCESS_MAX_PAGES=int(os.getenv('PREPROCESS_MAX_PAGES', 4)), PREPROCESS_JPEG_QUALITY=int(os.getenv('PREPROCESS_JPEG_QUALITY', 85)))
+app.config.from_mapping(CHAT_PROMPT_TOKEN_BUDGET=int(os.getenv('CHAT_PROMPT_TOKEN_BUDGET', 1500)), CHAT_SUMMARY_TRIGGER_TOKENS=int(os.getenv('CHAT_SUMMARY_TRIGGER_TOKENS', 800)))
+app.config.from_mapping(DB_POOL_SIZE=int(os.getenv('DB_POOL_SIZE', 5)), DB_MAX_OVERFLOW=int(os.getenv('DB_MAX_OVERFLOW', 10)), DB_POOL_RECYCLE=int(os.getenv('DB_POOL_RECYCLE', 1800)), DB_POOL_TIMEOUT=int(os.getenv('DB_POOL_TIMEOUT', 30)))
+app.config.from_mapping(ADMIN_PAGE_SIZE=int(os.getenv('ADMIN_PAGE_SIZE', 25)), ADMIN_STATS_TTL=int(os.getenv('ADMIN_STATS_TTL', 60)), ADMIN_STATS_DAYS=int(os.getenv('ADMIN_STATS_DAYS', 14)))
+app.config.from_mapping(BATCH_MAX_FILES=int(os.getenv('BATCH_MAX_FILES', 8)), BATCH_MAX_PARALLEL=int(os.getenv('BATCH_MAX_PARALLEL', 2)), BATCH_QUOTA_POLICY=os.getenv('BATCH_QUOTA_POLICY', 'per_file'))
+app.config.from_mapping(METRICS_TOKEN=os.getenv('METRICS_TOKEN'), METRICS_ALLOW_LOOPBACK=os.getenv('METRICS_ALLOW_LOOPBACK', 'false').lower() in ('1', 'true', 'yes'), PROFILE_SAMPLE_RATE=float(os.getenv('PROFILE_SAMPLE_RATE', 0)), PROFILE_FOLDER=os.getenv('PROFILE_FOLDER', 'profiles'))
+# Sessions are scoped to the current thread and released after every request (see
+# remove_db_session). Background jobs, streaming responses and SSE watchers open their own short
+# Session()s and hold a pooled connection only while reading or writing, never across a model
+# call or a poll interval, so the pool is not drained by slow work under threaded servers.
+def create_db_engine(url):
+    pool_options = dict(pool_pre_ping=True, pool_size=app.config['DB_POOL_SIZE'], max_overflow=app.config['DB_MAX_OVERFLOW'], pool_timeout=app.config['DB_POOL_TIMEOUT'], pool_recycle=app.config['DB_POOL_RECYCLE'])
+    if url.startswith('sqlite'):
+        if ':memory:' in url or url.rstrip('/') == 'sqlite:': return create_engine(url, connect_args={'check_same_thread': False})
+        return create_engine(url, connect_args={'check_same_thread': False, 'timeout': 30}, **pool_options)
+    return create_engine(url, **pool_options)
+Base = declarative_base(); engine = create_db_engine(app.config['SQLALCHEMY_DATABASE_URI']); Session = sessionmaker(bind=engine); db_session = scoped_session(Session)
+# Pooled connections must not be shared with processes forked after import (e.g. gunicorn --preload).
+os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
 @event.listens_for(Engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record): cursor = dbapi_connection.cursor(); cursor.execute("PRAGMA foreign_keys=ON"); cursor.close()
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection): return
+    # WAL lets readers proceed while a job or another worker is writing.
+    cursor = dbapi_connection.cursor(); cursor.execute("PRAGMA foreign_keys=ON"); cursor.execute("PRAGMA journal_mode=WAL"); cursor.close()
 def load_synonyms(path='specialty_synonyms.json'):
     try:
         with open(path, 'r', encoding='utf-8') as f: synonyms_data = json.load(f)
@@ -39,73 +79,886 @@ def load_synonyms(path='specialty_synonyms.json'):
 SYNONYMS, REVERSE_SYNONYMS = load_synonyms()
 VALID_SPECIALTIES = list(SYNONYMS.keys())
 
-# --- Models (unchanged) ---
+# --- Models ---
 class User(Base, UserMixin):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True); username = Column(String(80), unique=True, nullable=False); email = Column(String(120), unique=True, nullable=True); password_hash = Column(String(128), nullable=False); role = Column(String(10), nullable=False, default='user'); is_pro = Column(Boolean, nullable=False, default=False); upload_quota = Column(Integer, nullable=False, default=10); quota_reset_at = Column(DateTime); created_at = Column(DateTime, default=datetime.utcnow)
 class Doctor(Base):
     __tablename__ = 'doctors'
     id = Column(Integer, primary_key=True); name = Column(String, nullable=False); primary_specialty = Column(String, nullable=False); specialties = Column(Text); location_text = Column(String); clinic_address = Column(Text); profile_image = Column(String); notes = Column(Text)
+class CatalogMeta(Base):
+    __tablename__ = 'catalog_meta'
+    name = Column(String, primary_key=True); value = Column(String)
 class Query(Base):
     __tablename__ = 'queries'
     id = Column(Integer, primary_key=True); user_id = Column(Integer, ForeignKey('users.id'), nullable=False); input_type = Column(String); file_path = Column(String); user_text = Column(Text); medgemma_response = Column(Text); matched_doctor_ids = Column(Text); created_at = Column(DateTime, default=datetime.utcnow)
+class QueryDocument(Base):
+    __tablename__ = 'query_documents'
+    id = Column(Integer, primary_key=True); query_id = Column(Integer, ForeignKey('queries.id'), nullable=False, index=True); position = Column(Integer, nullable=False); name = Column(String); input_type = Column(String); file_path = Column(String); medgemma_response = Column(Text); error = Column(Text)
+class Job(Base):
+    __tablename__ = 'jobs'
+    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4())); user_id = Column(Integer, ForeignKey('users.id'), nullable=False); kind = Column(String(20), nullable=False); status = Column(String(10), nullable=False, default='queued'); payload = Column(Text); result = Column(Text); error = Column(Text); query_id = Column(Integer, ForeignKey('queries.id')); created_at = Column(DateTime, default=datetime.utcnow); started_at = Column(DateTime); finished_at = Column(DateTime)
+class Conversation(Base):
+    __tablename__ = 'conversations'
+    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4())); user_id = Column(Integer, ForeignKey('users.id'), nullable=False); kind = Column(String(20), nullable=False); summary = Column(Text); summarized_upto = Column(Integer, nullable=False, default=0); pending_job_id = Column(String(36)); summary_job_id = Column(String(36)); created_at = Column(DateTime, default=datetime.utcnow)
+class ConversationMessage(Base):
+    __tablename__ = 'conversation_messages'
+    id = Column(Integer, primary_key=True); conversation_id = Column(String(36), ForeignKey('conversations.id'), nullable=False, index=True); role = Column(String(10), nullable=False); content = Column(Text, nullable=False); created_at = Column(DateTime, default=datetime.utcnow)
 class Payment(Base):
     __tablename__ = 'payments'
     id = Column(Integer, primary_key=True); user_id = Column(Integer, ForeignKey('users.id'), nullable=False); amount = Column(Integer, default=0); status = Column(String, default='success (mock)'); txn_id = Column(String, unique=True, default=lambda: str(uuid.uuid4())); created_at = Column(DateTime, default=datetime.utcnow)
 Base.metadata.create_all(engine)
 
-# --- Flask-Login & Helpers (unchanged) ---
+# --- Metrics & Profiling ---
+# A small in-process registry rendered in the Prometheus text format at /metrics. Values are kept
+# per worker process, so scrape every worker when running under a multi-process server. Setting
+# PROFILE_SAMPLE_RATE profiles that fraction of requests with cProfile into PROFILE_FOLDER.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 40, 80, 160, 320)
+class Metrics:
+    """Thread-safe counters and histograms keyed by metric name and labels, plus scrape-time collectors."""
+    def __init__(self):
+        self.meta = {}; self.counters = {}; self.histograms = {}; self.collectors = {}; self._lock = threading.Lock()
+    def describe(self, name, kind, help_text, buckets=LATENCY_BUCKETS): self.meta[name] = (kind, help_text, buckets)
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock: self.counters[key] = self.counters.get(key, 0) + value
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items()))); buckets = self.meta[name][2]; i = bisect.bisect_left(buckets, value)
+        with self._lock:
+            counts = self.histograms.setdefault(key, [[0] * len(buckets), 0, 0.0])
+            if i < len(buckets): counts[0][i] += 1
+            counts[1] += 1; counts[2] += value
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try: yield
+        finally: self.observe(name, time.perf_counter() - started, **labels)
+    def collector(self, name, kind, help_text):
+        # The decorated function is called on every scrape and returns a number or {labels tuple: number}.
+        def register(func): self.describe(name, kind, help_text); self.collectors[name] = func; return func
+        return register
+    def render(self):
+        with self._lock: counters = dict(self.counters); histograms = {k: (list(v[0]), v[1], v[2]) for k, v in self.histograms.items()}
+        samples = {}
+        for (name, labels), value in counters.items(): samples.setdefault(name, []).append((name, labels, value))
+        for (name, labels), (counts, total, value_sum) in histograms.items():
+            cumulative = 0; series = samples.setdefault(name, [])
+            for le, count in zip(self.meta[name][2], counts): cumulative += count; series.append((f"{name}_bucket", labels + (('le', le),), cumulative))
+            series += [(f"{name}_bucket", labels + (('le', '+Inf'),), total), (f"{name}_count", labels, total), (f"{name}_sum", labels, value_sum)]
+        for name, collect in self.collectors.items():
+            try: values = collect()
+            except Exception: app.logger.exception("Metrics collector %s failed", name); continue
+            samples[name] = [(name, labels, value) for labels, value in (values if isinstance(values, dict) else {(): values}).items()]
+        lines = []
+        for name in sorted(samples):
+            kind, help_text, _ = self.meta[name]; lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for sample, labels, value in samples[name]:
+                label_text = ','.join(f'{k}="{self.escape(v)}"' for k, v in labels)
+                lines.append(f"{sample}{{{label_text}}} {value!r}" if label_text else f"{sample} {value!r}")
+        return '\n'.join(lines) + '\n'
+    @staticmethod
+    def escape(value): return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+metrics = Metrics()
+metrics.describe('http_request_duration_seconds', 'histogram', "Time spent in Flask views, to the first byte for streamed responses.")
+metrics.describe('http_request_db_queries', 'histogram', "Database statements executed per request.", COUNT_BUCKETS)
+metrics.describe('db_queries_total', 'counter', "Database statements executed, including background jobs.")
+metrics.describe('ai_stage_duration_seconds', 'histogram', "Time spent in each stage of the MedGemma analysis pipeline.")
+metrics.describe('lmstudio_requests_total', 'counter', "Completed LM Studio requests by host and outcome.")
+metrics.describe('lmstudio_completion_tokens_total', 'counter', "Tokens generated by LM Studio.")
+metrics.describe('lmstudio_tokens_per_second', 'histogram', "Generation throughput per LM Studio request, from send to last token.", RATE_BUCKETS)
+metrics.describe('lmstudio_time_to_first_token_seconds', 'histogram', "Delay before the first streamed token arrives.")
+metrics.describe('job_wait_seconds', 'histogram', "Time jobs spent queued before a worker picked them up.")
+metrics.describe('job_duration_seconds', 'histogram', "Time jobs spent running.")
+metrics.describe('jobs_total', 'counter', "Finished jobs by kind and final status.")
+metrics.describe('preprocess_pool_restarts_total', 'counter', "Document preprocessing pools replaced after a worker died.")
+metrics.describe('ai_json_repairs_total', 'counter', "Unusable JSON replies sent back for a repair call, by outcome.")
+@event.listens_for(Engine, "before_cursor_execute")
+def count_db_query(conn, cursor, statement, parameters, context, executemany):
+    metrics.inc('db_queries_total')
+    if has_request_context(): g.db_queries = g.get('db_queries', 0) + 1
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter(); g.db_queries = 0
+    if app.config['PROFILE_SAMPLE_RATE'] and random.random() < app.config['PROFILE_SAMPLE_RATE']:
+        profiler = cProfile.Profile()
+        try: profiler.enable(); g.profiler = profiler
+        except ValueError: pass  # another profiler is already active in this process
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'unmatched'
+    if 'request_started' in g:
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - g.request_started, endpoint=endpoint, method=request.method, status=str(response.status_code))
+        metrics.observe('http_request_db_queries', g.db_queries, endpoint=endpoint)
+    profiler = g.pop('profiler', None)
+    if profiler:
+        profiler.disable(); os.makedirs(app.config['PROFILE_FOLDER'], exist_ok=True)
+        profiler.dump_stats(os.path.join(app.config['PROFILE_FOLDER'], f"{datetime.utcnow():%Y%m%dT%H%M%S}-{endpoint}-{uuid.uuid4().hex[:8]}.prof"))
+    return response
+
+# --- Flask-Login & Helpers ---
 login_manager = LoginManager(); login_manager.init_app(app); login_manager.login_view = 'login'
 @login_manager.user_loader
 def load_user(user_id): return db_session.query(User).get(int(user_id))
+FREE_UPLOAD_QUOTA = 10
 def allowed_file(filename): return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'png', 'jpg', 'jpeg', 'pdf'}
+@app.teardown_appcontext
+def remove_db_session(exception=None):
+    if exception: db_session.rollback()
+    db_session.remove()
 @app.before_request
 def before_request():
     g.user = current_user
     if g.user.is_authenticated and not g.user.is_pro:
         if not g.user.quota_reset_at or datetime.utcnow() > g.user.quota_reset_at:
-            g.user.upload_quota = 10; g.user.quota_reset_at = datetime.utcnow() + timedelta(days=30); db_session.commit(); flash('Your monthly upload quota has been reset!', 'success')
-def decrement_quota(user):
-    if not user.is_pro and user.upload_quota > 0: user.upload_quota -= 1; db_session.commit()
+            g.user.upload_quota = FREE_UPLOAD_QUOTA; g.user.quota_reset_at = datetime.utcnow() + timedelta(days=30); db_session.commit(); flash('Your monthly upload quota has been reset!', 'success')
+def decrement_quota(user, amount=1):
+    if not user.is_pro and user.upload_quota > 0: user.upload_quota = max(0, user.upload_quota - amount); db_session.commit()
+
+# --- Content-Addressed Upload Store ---
+# Uploads are stored as <sha256>.<ext>, so identical bytes land on disk exactly once and the
+# hash doubles as the file half of the AI result cache key.
+def save_upload(file):
+    ext = file.filename.rsplit('.', 1)[1].lower(); hasher = hashlib.sha256()
+    tmp_path = os.path.join(app.config['UPLOAD_FOLDER'], f".{uuid.uuid4().hex}.tmp")
+    try:
+        with open(tmp_path, 'wb') as out:
+            for chunk in iter(lambda: file.stream.read(64 * 1024), b''): hasher.update(chunk); out.write(chunk)
+    except BaseException:
+        os.remove(tmp_path); raise  # the client went away or the upload was too large
+    digest = hasher.hexdigest(); fpath = os.path.join(app.config['UPLOAD_FOLDER'], f"{digest}.{ext}")
+    if os.path.exists(fpath): os.remove(tmp_path)
+    else: os.replace(tmp_path, fpath)
+    return fpath, digest
+def file_digest(file_path):
+    stem = os.path.basename(file_path).rsplit('.', 1)[0]
+    if re.fullmatch(r'[0-9a-f]{64}', stem): return stem
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''): hasher.update(chunk)
+    return hasher.hexdigest()
 
-# --- AI & Doctor Matching (unchanged) ---
-def get_medgemma_response(text=None, file_path=None, mode='standard', history=None):
-    api_url = urljoin(app.config['LMSTUDIO_HOST'], "v1/chat/completions")
-    headers = {"Authorization": f"Bearer {app.config['LMSTUDIO_API_KEY']}"}
+# --- AI Result Cache ---
+class AIResultCache:
+    """Thread-safe LRU of MedGemma responses, bounded by entry count, total bytes and age."""
+    def __init__(self, max_entries, max_bytes, ttl):
+        self.max_entries, self.max_bytes, self.ttl = max_entries, max_bytes, ttl
+        self._entries = OrderedDict(); self._bytes = 0; self._lock = threading.Lock()
+        self.hits = self.misses = 0
+    @staticmethod
+    def make_key(file_hash, text, model, mode):
+        return (file_hash or '', ' '.join((text or '').split()).lower(), model, mode)
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() - entry[1] <= self.ttl:
+                self._entries.move_to_end(key); self.hits += 1; return entry[0]
+            if entry: self._evict(key)
+            self.misses += 1; return None
+    def put(self, key, value):
+        size = len(value.encode('utf-8'))
+        if size > self.max_bytes: return
+        with self._lock:
+            if key in self._entries: self._evict(key)
+            self._entries[key] = (value, time.monotonic(), size); self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._evict(next(iter(self._entries)))
+    def _evict(self, key): self._bytes -= self._entries.pop(key)[2]
+ai_cache = AIResultCache(app.config['AI_CACHE_MAX_ENTRIES'], app.config['AI_CACHE_MAX_BYTES'], app.config['AI_CACHE_TTL'])
+@metrics.collector('ai_cache_requests_total', 'counter', "AI result cache lookups by outcome.")
+def ai_cache_requests(): return {(('result', 'hit'),): ai_cache.hits, (('result', 'miss'),): ai_cache.misses}
+@metrics.collector('ai_cache_bytes', 'gauge', "Bytes of MedGemma responses held in the AI result cache.")
+def ai_cache_bytes(): return ai_cache._bytes
+
+# --- Document Preprocessing ---
+# Uploads are turned into model-sized JPEGs in a separate process pool, so rasterizing and
+# re-encoding never runs on a request or job thread. Rendered pages are cached on disk under
+# <file hash>-<page>-<size>.jpg and reused across queries of the same file.
+def parse_page_selection(spec, max_pages):
+    """Turns a 1-based selection such as "1-3,5" into sorted 0-based page numbers."""
+    pages = set()
+    for part in (spec or '').replace(' ', '').split(','):
+        if not part: continue
+        first, _, last = part.partition('-')
+        if not first.isdigit() or (last and not last.isdigit()) or int(first) < 1 or int(last or first) < int(first): raise ValueError(f"Invalid page selection: {part}")
+        pages.update(range(int(first) - 1, int(last or first)))
+    if len(pages) > max_pages: raise ValueError(f"Please select at most {max_pages} pages.")
+    return sorted(pages)
+_preprocess_pool = None; _preprocess_pool_lock = threading.Lock()
+def preprocess_pool(broken=None):
+    # Workers are started fresh (forkserver, or spawn where that is unavailable) instead of forked
+    # from a process full of threads and open connections. Passing the pool that just broke replaces
+    # it, unless another thread has already done so.
+    global _preprocess_pool
+    with _preprocess_pool_lock:
+        if broken is not None and _preprocess_pool is broken: broken.shutdown(wait=False, cancel_futures=True); _preprocess_pool = None; metrics.inc('preprocess_pool_restarts_total')
+        if _preprocess_pool is None:
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+            _preprocess_pool = ProcessPoolExecutor(max_workers=app.config['PREPROCESS_WORKERS'], mp_context=context)
+        return _preprocess_pool
+def prepare_document_images(file_path, digest, pages=None):
+    args = (file_path, digest, app.config['RENDER_CACHE_FOLDER'], app.config['PREPROCESS_MAX_SIDE'], pages, app.config['PREPROCESS_MAX_PAGES'], app.config['PREPROCESS_JPEG_QUALITY'])
+    with metrics.timer('ai_stage_duration_seconds', stage='render'):
+        pool = preprocess_pool()
+        try: paths = pool.submit(render_document, *args).result()
+        # A worker died (out of memory, a crashing decoder), which breaks the whole pool: retry once on a new one.
+        except BrokenProcessPool: paths = preprocess_pool(broken=pool).submit(render_document, *args).result()
+    images = []
+    with metrics.timer('ai_stage_duration_seconds', stage='encode'):
+        for path in paths:
+            with open(path, 'rb') as f: images.append(base64.b64encode(f.read()).decode('utf-8'))
+    return images
+
+# --- LM Studio Inference Client ---
+# One pooled keep-alive session shared by every model call. LMSTUDIO_HOST may list several
+# comma-separated endpoints; requests go to the least busy host whose circuit breaker is closed,
+# and connection failures / 5xx responses are retried on the next host with jittered backoff.
+# Every call, queued or streamed, takes one of max_concurrency slots for its whole duration.
+class InferenceError(Exception): pass
+class InferenceUnavailable(InferenceError): pass
+class CircuitBreaker:
+    def __init__(self, threshold, cooldown):
+        self.threshold, self.cooldown = threshold, cooldown; self.failures = 0; self.opened_at = None; self.probing = False
+    def available(self):
+        if self.opened_at is None: return True
+        return not self.probing and time.monotonic() - self.opened_at >= self.cooldown
+    def acquire(self):
+        if self.opened_at is not None: self.probing = True  # half-open: let a single trial request through
+    def record_success(self): self.failures = 0; self.opened_at = None; self.probing = False
+    def record_failure(self):
+        self.failures += 1; self.probing = False
+        if self.failures >= self.threshold: self.opened_at = time.monotonic()
+class InferenceClient:
+    def __init__(self, hosts, api_key, pool_size, connect_timeout, read_timeout, max_retries, breaker_threshold, breaker_cooldown, structured_output=True, max_concurrency=2, stream_wait=30):
+        self.slots = threading.BoundedSemaphore(max_concurrency); self.stream_wait = stream_wait; self.structured_output = structured_output; self.hosts = [h.strip() for h in (hosts or '').split(',') if h.strip()]; self.api_key = api_key
+        self.timeout = (connect_timeout, read_timeout); self.max_retries = max_retries
+        self.breakers = {h: CircuitBreaker(breaker_threshold, breaker_cooldown) for h in self.hosts}
+        self.in_flight = {h: 0 for h in self.hosts}; self._lock = threading.Lock(); self._turn = 0
+        self.session = requests.Session(); self.session.headers['Authorization'] = f"Bearer {api_key}"
+        adapter = HTTPAdapter(pool_connections=max(len(self.hosts), 1), pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('http://', adapter); self.session.mount('https://', adapter)
+    @contextmanager
+    def _slot(self, timeout=None):
+        if not self.slots.acquire(timeout=timeout): raise InferenceUnavailable("The AI service is busy. Please try again shortly.")
+        try: yield
+        finally: self.slots.release()
+    def _pick_host(self):
+        with self._lock:
+            candidates = [h for h in self.hosts if self.breakers[h].available()]
+            if not candidates: raise InferenceUnavailable("All LM Studio endpoints are unavailable.")
+            self._turn += 1; start = self._turn % len(candidates)
+            host = min(candidates[start:] + candidates[:start], key=lambda h: self.in_flight[h])
+            self.breakers[host].acquire(); self.in_flight[host] += 1
+            return host
+    def _release(self, host, ok):
+        with self._lock:
+            self.in_flight[host] -= 1; metrics.inc('lmstudio_requests_total', host=host, outcome='ok' if ok else 'error')
+            if ok: self.breakers[host].record_success()
+            else: self.breakers[host].record_failure()
+    def _post(self, payload, stream=False):
+        # Returns (host, response). Only failures that happen before the model starts answering are
+        # retried; read timeouts are not, since the request may still be generating upstream.
+        for attempt in range(self.max_retries + 1):
+            host = self._pick_host()
+            try: response = self.session.post(urljoin(host, "v1/chat/completions"), json=payload, stream=stream, timeout=self.timeout)
+            except requests.ConnectionError as e: error = e
+            except Exception: self._release(host, ok=False); raise
+            else:
+                if response.status_code < 400: return host, response
+                response.close()
+                if response.status_code < 500: self._release(host, ok=True); response.raise_for_status()
+                error = InferenceError(f"LM Studio returned HTTP {response.status_code}")
+            self._release(host, ok=False)
+            if attempt < self.max_retries: time.sleep(random.uniform(0, min(8.0, 0.5 * 2 ** attempt)))
+        raise error
+    def build_payload(self, messages, stream=False, max_tokens=1500, schema=None):
+        payload = {"model": app.config['MEDGEMMA_MODEL'], "messages": messages, "temperature": 0.7, "max_tokens": max_tokens, "stream": stream}
+        if schema and self.structured_output: payload["response_format"] = {"type": "json_schema", "json_schema": schema}
+        return payload
+    def _send(self, messages, stream, max_tokens, schema):
+        # A backend that rejects response_format is remembered and gets the schema in the prompt only.
+        try: return self._post(self.build_payload(messages, stream, max_tokens, schema), stream=stream)
+        except requests.HTTPError as e:
+            if not (schema and self.structured_output and e.response is not None and e.response.status_code in (400, 422)): raise
+            self.structured_output = False
+            try: sent = self._post(self.build_payload(messages, stream, max_tokens), stream=stream)
+            except Exception: self.structured_output = True; raise
+            app.logger.warning("LM Studio rejected response_format (%s); falling back to prompt-only JSON.", e); return sent
+    def _record_throughput(self, mode, tokens, elapsed):
+        metrics.inc('lmstudio_completion_tokens_total', tokens, mode=mode)
+        if elapsed > 0: metrics.observe('lmstudio_tokens_per_second', tokens / elapsed, mode=mode)
+    def chat(self, messages, max_tokens=1500, schema=None):
+        with self._slot():
+            started = time.perf_counter(); host, response = self._send(messages, False, max_tokens, schema); ok = False
+            try: body = response.json(); content = body['choices'][0]['message']['content']; ok = True
+            finally: self._release(host, ok)
+        self._record_throughput('chat', (body.get('usage') or {}).get('completion_tokens') or estimate_tokens(content), time.perf_counter() - started)
+        return content
+    def stream_chat(self, messages, max_tokens=1500, schema=None):
+        # A browser is waiting, so give up after stream_wait seconds rather than queueing indefinitely.
+        with self._slot(self.stream_wait):
+            started = time.perf_counter(); host, response = self._send(messages, True, max_tokens, schema); ok = False
+            tokens = 0  # LM Studio sends one token per chunk
+            try:
+                with response:
+                    # SSE is always UTF-8, but requests would fall back to ISO-8859-1 for a text/* reply without a charset.
+                    response.encoding = 'utf-8'
+                    for line in response.iter_lines(decode_unicode=True):
+                        if not line or not line.startswith('data:'): continue
+                        data = line[5:].strip()
+                        if data == '[DONE]': break
+                        delta = (json.loads(data)['choices'][0].get('delta') or {}).get('content')
+                        if not delta: continue
+                        if not tokens: metrics.observe('lmstudio_time_to_first_token_seconds', time.perf_counter() - started)
+                        tokens += 1; yield delta
+                ok = True; self._record_throughput('stream', tokens, time.perf_counter() - started)
+            except GeneratorExit: ok = True; raise  # the browser went away; not the host's fault
+            finally: self._release(host, ok)
+inference_client = InferenceClient(app.config['LMSTUDIO_HOST'], app.config['LMSTUDIO_API_KEY'], app.config['LMSTUDIO_POOL_SIZE'], app.config['LMSTUDIO_CONNECT_TIMEOUT'], app.config['LMSTUDIO_READ_TIMEOUT'], app.config['LMSTUDIO_MAX_RETRIES'], app.config['LMSTUDIO_BREAKER_THRESHOLD'], app.config['LMSTUDIO_BREAKER_COOLDOWN'], app.config['LMSTUDIO_STRUCTURED_OUTPUT'],
+                                   app.config['MEDGEMMA_MAX_CONCURRENCY'], app.config['MEDGEMMA_STREAM_WAIT'])
+@metrics.collector('lmstudio_in_flight', 'gauge', "Model requests currently in flight per LM Studio host.")
+def lmstudio_in_flight(): return {(('host', h),): n for h, n in inference_client.in_flight.items()}
+@metrics.collector('lmstudio_circuit_open', 'gauge', "1 while a host's circuit breaker is open.")
+def lmstudio_circuit_open(): return {(('host', h),): int(b.opened_at is not None) for h, b in inference_client.breakers.items()}
+
+# --- Structured Model Output ---
+# JSON answers are requested with a response_format JSON schema, which LM Studio enforces with a
+# grammar. Replies are still parsed tolerantly (prose around the object, trailing commas, a
+# truncated tail), and one that is still unusable gets a single text-only repair call rather than
+# a full re-analysis with the document images.
+def json_schema(name, **properties):
+    return {"name": name, "strict": True, "schema": {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}}
+ANALYSIS_SCHEMA = json_schema('medical_analysis', SUMMARY={"type": "string"}, FINDINGS={"type": "string"}, SUGGESTED_SPECIALTIES={"type": "string"}, CONFIDENCE={"type": "string"}, NEXT_STEPS={"type": "string"})
+SYMPTOM_QUESTION_SCHEMA = json_schema('symptom_question', question={"type": "string"}, is_final={"type": "boolean"})
+SYMPTOM_FINAL_SCHEMA = json_schema('symptom_analysis', POSSIBLE_CAUSES={"type": "string"}, SUGGESTED_SPECIALTIES={"type": "string"}, NEXT_STEPS={"type": "string"})
+RESPONSE_SCHEMAS = {schema['name']: schema for schema in (ANALYSIS_SCHEMA, SYMPTOM_QUESTION_SCHEMA, SYMPTOM_FINAL_SCHEMA)}
+def parse_model_json(text, schema):
+    """Returns (object, required text keys that are missing or empty) from a reply meant to hold one JSON object."""
+    text = text or ''; start = text.find('{'); data = None
+    if start != -1:
+        for candidate in (text, re.sub(r',\s*([}\]])', r'\1', text)):
+            try: data = json.JSONDecoder().raw_decode(candidate, candidate.find('{'))[0]; break
+            except json.JSONDecodeError: pass
+        # Still broken (usually cut off by max_tokens): keep the top-level strings that did arrive.
+        # The value that was cut off mid-string is incomplete, so it counts as missing.
+        if not isinstance(data, dict):
+            stream = JSONFieldStream(); fields = stream.feed(text[start:]); fields.pop(stream.open_key(), None)
+            data = {k: v for k, v in fields.items() if k}
+    data = data if isinstance(data, dict) else {}
+    properties = schema['schema']['properties']
+    return data, [k for k, v in properties.items() if v['type'] == 'string' and not str(data.get(k) or '').strip()]
+def parse_structured_reply(text, schema):
+    with metrics.timer('ai_stage_duration_seconds', stage='parse'): data, missing = parse_model_json(text, schema)
+    if not missing: return data
+    # An empty reply or plain prose names none of the fields; a repair call could only make an answer up.
+    if not any(f'"{k}"' in (text or '') for k, v in schema['schema']['properties'].items() if v['type'] == 'string'): raise ValueError("The AI response did not contain a usable answer. Please try again.")
+    keys = ', '.join(f'"{k}"' for k in schema['schema']['properties'])
+    prompt = [{"role": "system", "content": f"The text below was meant to be a single JSON object with the keys {keys}, but it is invalid or incomplete (missing: {', '.join(missing)}). Rewrite it as that JSON object, keeping its content. Reply with the JSON object only."},
+              {"role": "user", "content": text or '(empty reply)'}]
+    with metrics.timer('ai_stage_duration_seconds', stage='repair'): repaired, still_missing = parse_model_json(inference_client.chat(prompt, max_tokens=800, schema=schema), schema)
+    metrics.inc('ai_json_repairs_total', outcome='failed' if still_missing else 'fixed')
+    if still_missing: raise ValueError("The AI response was incomplete. Please try again.")
+    return {**data, **repaired}
+def normalize_analysis(result):
+    """Splits FINDINGS into lines and SUGGESTED_SPECIALTIES into names; already split values pass through."""
+    findings, specialties = result.get('FINDINGS') or [], result.get('SUGGESTED_SPECIALTIES') or []
+    findings = (str(line).strip().lstrip('*-• ') for line in (findings.split('\n') if isinstance(findings, str) else findings))
+    specialties = (str(spec).strip() for spec in (specialties.split(',') if isinstance(specialties, str) else specialties))
+    return {**result, 'FINDINGS': [line for line in findings if line], 'SUGGESTED_SPECIALTIES': list(dict.fromkeys(spec for spec in specialties if spec))}
+
+# --- AI & Doctor Matching ---
+THERAPEUTIC_SYSTEM_PROMPT = "You are a compassionate AI assistant. Respond directly to the user's last message in a supportive, conversational tone. Do not output JSON."
+def get_medgemma_response(text=None, file_path=None, mode='standard', history=None, pages=None, summary=None):
     if mode == 'standard':
+        digest = file_digest(file_path) if file_path else None
+        cache_key = ai_cache.make_key(f"{digest}:{','.join(map(str, pages))}" if digest and pages else digest, text, app.config['MEDGEMMA_MODEL'], mode)
+        cached = ai_cache.get(cache_key)
+        if cached: return cached
         system_prompt = f'You are a professional medical AI assistant. Your response MUST be ONLY a single, valid JSON object with keys "SUMMARY", "FINDINGS", "SUGGESTED_SPECIALTIES", "CONFIDENCE", and "NEXT_STEPS". The value for "FINDINGS" must be a single string with each finding separated by a newline (\\n). The value for "SUGGESTED_SPECIALTIES" MUST be a single string of one or more specialties separated by a comma, chosen ONLY from this exact list: {json.dumps(VALID_SPECIALTIES)}. All text values must be in clear, beginner-friendly English.'
         messages = [{"role": "system", "content": system_prompt}]
         content_parts = [{"type": "text", "text": text or "Analyze this medical document."}]
         if file_path:
             try:
-                ext = file_path.rsplit('.', 1)[1].lower()
-                if ext == 'pdf': doc = fitz.open(file_path); page = doc.load_page(0); pix = page.get_pixmap(dpi=150); img_bytes = pix.tobytes("png"); base64_image = base64.b64encode(img_bytes).decode('utf-8'); doc.close()
-                else:
-                    with open(file_path, "rb") as f: base64_image = base64.b64encode(f.read()).decode('utf-8')
-                content_parts.append({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{base64_image}"}})
+                for base64_image in prepare_document_images(file_path, digest, pages):
+                    content_parts.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}})
             except Exception as e: return json.dumps({"error": f"Failed to process file: {e}"})
         messages.append({"role": "user", "content": content_parts})
     else:
-        system_prompt = "You are a compassionate AI assistant. Respond directly to the user's last message in a supportive, conversational tone. Do not output JSON."
-        messages = [{"role": "system", "content": system_prompt}] + history
-    payload = {"model": "medgemma-4b-it", "messages": messages, "temperature": 0.7, "max_tokens": 1500, "stream": False}
+        messages = [{"role": "system", "content": with_summary(THERAPEUTIC_SYSTEM_PROMPT, summary)}] + history
     try:
-        response = requests.post(api_url, headers=headers, json=payload, timeout=180); response.raise_for_status()
-        ai_content_str = response.json()['choices'][0]['message']['content']
+        with metrics.timer('ai_stage_duration_seconds', stage='inference'): ai_content_str = inference_client.chat(messages, schema=ANALYSIS_SCHEMA if mode == 'standard' else None)
         if mode == 'standard':
-            json_start = ai_content_str.find('{'); json_end = ai_content_str.rfind('}') + 1
-            return ai_content_str[json_start:json_end] if json_start != -1 else json.dumps({"error": "No JSON found"})
+            try: result_str = json.dumps(normalize_analysis(parse_structured_reply(ai_content_str, ANALYSIS_SCHEMA)))
+            except ValueError as e: return json.dumps({"error": str(e)})
+            ai_cache.put(cache_key, result_str); return result_str
         else:
             return ai_content_str
     except Exception as e:
         if mode == 'therapeutic': return "I'm sorry, I'm having a connection issue."
         else: return json.dumps({"error": f"AI server connection failed: {e}"})
-def find_matching_doctors(specialties_list):
-    if not specialties_list: return []
-    search_terms = {REVERSE_SYNONYMS.get(s.strip().title(), s.strip().title()) for s in specialties_list}
-    return db_session.query(Doctor).filter(Doctor.primary_specialty.in_(search_terms)).limit(6).all()
+def with_summary(system_prompt, summary): return f"{system_prompt}\n\nSummary of the earlier conversation: {summary}" if summary else system_prompt
+def symptom_checker_system_prompt(is_final_turn):
+    if is_final_turn:
+        system_prompt = f'You are a symptom analysis AI. Based on the conversation, provide a final analysis. Your response MUST be ONLY a single, valid JSON object with keys "POSSIBLE_CAUSES", "SUGGESTED_SPECIALTIES", and "NEXT_STEPS". The value for "SUGGESTED_SPECIALTIES" MUST be a single string of specialties separated by a comma, chosen ONLY from this list: {json.dumps(VALID_SPECIALTIES)}. All text values must be in clear, beginner-friendly English.'
+    else:
+        system_prompt = 'You are a symptom checker AI. Ask only ONE clarifying question. Your response MUST be ONLY a single, valid JSON object with two keys: "question" (your follow-up question) and "is_final" (which must be the boolean value false).'
+
+    return system_prompt
+def symptom_schema(is_final_turn): return SYMPTOM_FINAL_SCHEMA if is_final_turn else SYMPTOM_QUESTION_SCHEMA
+def parse_symptom_response(ai_content_str, is_final_turn):
+    response_data = parse_structured_reply(ai_content_str, symptom_schema(is_final_turn))
+    if is_final_turn:
+        # Add the 'is_final' flag for the frontend to know it's the last step
+        response_data['is_final'] = True
+    return response_data
+def find_matching_doctors(specialties_list, near=None, limit=6):
+    return doctor_search_index().match(tuple(s.strip() for s in specialties_list or () if s.strip()), near, limit)
+
+# --- Doctor Search Index ---
+# The doctor catalog is small and read-mostly, so searches run against an in-memory trigram index
+# instead of ILIKE table scans. init_db.py bumps catalog_meta.doctors_version after every import;
+# the index is rebuilt when that version changes. It also keeps every specialty's doctors pre-ranked
+# for matching AI results to doctors, with each answered match memoized until the next rebuild.
+DoctorCard = namedtuple('DoctorCard', 'id name primary_specialty specialties location_text clinic_address profile_image')
+def district_of(location_text): return (location_text or '').split(',')[0].strip()
+def normalize_search_text(text): return ' '.join(re.sub(r'[^0-9a-z]+', ' ', (text or '').lower()).split())
+def trigrams(text):
+    grams = set()
+    for word in normalize_search_text(text).split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+class DoctorSearchIndex:
+    FIELDS = {'name': ('name',), 'location': ('location_text', 'clinic_address')}
+    def __init__(self, doctors, version=None):
+        self.version = version; self.cards = {}; self.texts = {}; self.postings = {f: {} for f in self.FIELDS}; self.by_specialty = {}
+        for d in doctors:
+            extra = json.loads(d.specialties) if d.specialties else []
+            card = DoctorCard(d.id, d.name, d.primary_specialty, tuple(extra), d.location_text, d.clinic_address, d.profile_image); self.cards[d.id] = card
+            for spec in {d.primary_specialty, *extra}: self.by_specialty.setdefault(spec, set()).add(d.id)
+            for field, columns in self.FIELDS.items():
+                text = ' '.join(getattr(card, c) or '' for c in columns); self.texts[(field, d.id)] = normalize_search_text(text)
+                for gram in trigrams(text): self.postings[field].setdefault(gram, []).append(d.id)
+        self.alphabetical = sorted((0, c.name.lower(), c.id) for c in self.cards.values())
+        # Doctors listing a specialty as primary come before those listing it as secondary, then
+        # complete profiles before sparse ones, then by name.
+        self.ranked_by_specialty = {spec: sorted(ids, key=lambda i: (self.cards[i].primary_specialty != spec, not (self.cards[i].profile_image and self.cards[i].clinic_address), self.cards[i].name.lower(), i))
+                                    for spec, ids in self.by_specialty.items()}
+        self.specialty_names = {spec.lower(): spec for spec in self.by_specialty}
+        self.districts = sorted({district_of(c.location_text) for c in self.cards.values()} - {''}); self.district_names = {d.lower(): d for d in self.districts}
+        self._matches = {}
+    def canonical_specialty(self, name): return self.specialty_names.get(REVERSE_SYNONYMS.get(name.title(), name).lower())
+    def match(self, specialties, near=None, limit=6):
+        # Takes the best remaining doctor of each suggested specialty in turn, so every suggestion is
+        # represented; doctors in the `near` district go first within each specialty.
+        near = self.district_names.get((near or '').strip().lower()); key = (specialties, near, limit)
+        matched = self._matches.get(key)
+        if matched is not None: return matched
+        ranked = [self.ranked_by_specialty[spec] for spec in dict.fromkeys(filter(None, map(self.canonical_specialty, specialties)))]
+        if near: ranked = [[i for i in ids if district_of(self.cards[i].location_text) == near] + [i for i in ids if district_of(self.cards[i].location_text) != near] for ids in ranked]
+        picked = {}
+        for rank in range(max(map(len, ranked), default=0)):
+            for ids in ranked:
+                if rank < len(ids): picked.setdefault(ids[rank])
+            if len(picked) >= limit: break
+        matched = [self.cards[i] for i in list(picked)[:limit]]
+        if len(self._matches) >= 4096: self._matches.clear()
+        self._matches[key] = matched; return matched
+    def cards_for(self, doctor_ids): return [self.cards[i] for i in doctor_ids if i in self.cards]
+    def _match(self, field, query, min_similarity):
+        # Share of the query's trigrams found in the field, plus a bonus for an exact substring hit.
+        grams = trigrams(query); needle = normalize_search_text(query)
+        if not grams: return {}
+        counts = Counter()
+        for gram in grams: counts.update(self.postings[field].get(gram, ()))
+        scores = {}
+        for doc_id, hits in counts.items():
+            score = hits / len(grams)
+            if needle in self.texts[(field, doc_id)]: score += 1
+            if score >= min_similarity: scores[doc_id] = score
+        return scores
+    def search(self, name='', specialty='', location='', cursor=None, limit=24, min_similarity=0.5):
+        candidates = None; scores = Counter()
+        if specialty:
+            canonical = REVERSE_SYNONYMS.get(specialty.strip().title(), specialty.strip())
+            candidates = set(self.by_specialty.get(canonical, ()))
+        for field, query in (('name', name), ('location', location)):
+            if not query: continue
+            matched = self._match(field, query, min_similarity)
+            candidates = set(matched) if candidates is None else candidates & matched.keys()
+            for doc_id in candidates: scores[doc_id] += matched[doc_id]
+        # Results are ordered by (-score, name, id); the cursor is the last key of the previous page.
+        if candidates is None: ranked = self.alphabetical
+        else: ranked = sorted((-scores[i], self.cards[i].name.lower(), i) for i in candidates)
+        start = bisect.bisect_right(ranked, tuple(cursor)) if cursor else 0
+        page = ranked[start:start + limit]
+        next_cursor = list(page[-1]) if page and start + limit < len(ranked) else None
+        return [self.cards[key[2]] for key in page], next_cursor, len(ranked)
+_doctor_index = None; _doctor_index_checked = 0.0; _doctor_index_lock = threading.Lock()
+def doctor_search_index():
+    global _doctor_index, _doctor_index_checked
+    if _doctor_index and time.monotonic() - _doctor_index_checked < app.config['DOCTOR_INDEX_REFRESH_INTERVAL']: return _doctor_index
+    with _doctor_index_lock:
+        s = Session()
+        try:
+            meta = s.get(CatalogMeta, 'doctors_version'); version = meta.value if meta else None
+            if not _doctor_index or _doctor_index.version != version: _doctor_index = DoctorSearchIndex(s.query(Doctor).all(), version)
+        finally: s.close()
+        _doctor_index_checked = time.monotonic()
+    return _doctor_index
+def encode_cursor(cursor): return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode() if cursor else None
+def decode_cursor(token, *types):
+    # Cursors come from the query string, so anything not shaped like `types` is ignored.
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(token.encode()))
+        valid = isinstance(cursor, list) and len(cursor) == len(types) and all(isinstance(v, t) and not isinstance(v, bool) for v, t in zip(cursor, types))
+        return cursor if valid else None
+    except (ValueError, TypeError): return None
+
+# --- Admin Data Layer ---
+# Admin tables page with keyset cursors (sort value, id) rather than OFFSET, and every count is a
+# SQL aggregate. Daily activity is cached and only the current day is recomputed on refresh.
+ADMIN_SORTS = {
+    'users': {'id': User.id, 'username': User.username},
+    'doctors': {'name': Doctor.name, 'specialty': Doctor.primary_specialty, 'location': func.coalesce(Doctor.location_text, '')},
+}
+def keyset_page(query, sort_expr, id_column, descending, cursor, limit):
+    if cursor:
+        value, last_id = cursor
+        if descending: query = query.filter(or_(sort_expr < value, and_(sort_expr == value, id_column < last_id)))
+        else: query = query.filter(or_(sort_expr > value, and_(sort_expr == value, id_column > last_id)))
+    order = (sort_expr.desc(), id_column.desc()) if descending else (sort_expr.asc(), id_column.asc())
+    rows = query.add_columns(sort_expr).order_by(*order).limit(limit + 1).all()
+    next_cursor = [rows[limit - 1][1], rows[limit - 1][0].id] if len(rows) > limit else None
+    return [row[0] for row in rows[:limit]], next_cursor
+def admin_table(name, query, id_column, args):
+    sort = args.get(f'{name}_sort') if args.get(f'{name}_sort') in ADMIN_SORTS[name] else next(iter(ADMIN_SORTS[name]))
+    descending = args.get(f'{name}_dir') == 'desc'; sort_expr = ADMIN_SORTS[name][sort]
+    total = query.with_entities(func.count(id_column)).scalar()
+    value_type = int if sort == 'id' else str
+    cursor = decode_cursor(args.get(f'{name}_after', ''), value_type, int)
+    rows, next_cursor = keyset_page(query, sort_expr, id_column, descending, cursor, app.config['ADMIN_PAGE_SIZE'])
+    return {'rows': rows, 'total': total, 'sort': sort, 'dir': 'desc' if descending else 'asc', 'next': encode_cursor(next_cursor), 'first_page': cursor is None}
+class AdminStats:
+    def __init__(self, ttl, days):
+        self.ttl, self.days = ttl, days; self.daily = {}; self.totals = {}; self.computed_through = None; self.refreshed_at = 0.0; self._lock = threading.Lock()
+    def snapshot(self):
+        with self._lock:
+            if time.monotonic() - self.refreshed_at >= self.ttl: self._refresh()
+            return {'totals': dict(self.totals), 'daily': [dict(day=d, **self.daily[d]) for d in sorted(self.daily, reverse=True)]}
+    def _refresh(self):
+        s = Session()
+        try:
+            today = datetime.utcnow().date(); window_start = today - timedelta(days=self.days - 1)
+            # Past days never change, so only the last computed day (possibly partial) onwards is re-read.
+            start = max(self.computed_through or window_start, window_start)
+            fresh = {}
+            for day, queries, uploads in s.query(func.date(Query.created_at), func.count(Query.id), func.count(Query.file_path)).filter(Query.created_at >= start).group_by(func.date(Query.created_at)):
+                fresh.setdefault(str(day), {'queries': 0, 'uploads': 0, 'pro_conversions': 0}).update(queries=queries, uploads=uploads)
+            # Batch queries keep their files on QueryDocument rows (the parent's file_path is empty).
+            for day, documents in s.query(func.date(Query.created_at), func.count(QueryDocument.id)).join(QueryDocument, QueryDocument.query_id == Query.id).filter(Query.created_at >= start).group_by(func.date(Query.created_at)):
+                fresh.setdefault(str(day), {'queries': 0, 'uploads': 0, 'pro_conversions': 0})['uploads'] += documents
+            for day, conversions in s.query(func.date(Payment.created_at), func.count(Payment.id)).filter(Payment.created_at >= start).group_by(func.date(Payment.created_at)):
+                fresh.setdefault(str(day), {'queries': 0, 'uploads': 0, 'pro_conversions': 0})['pro_conversions'] = conversions
+            for offset in range((today - start).days + 1): self.daily[str(start + timedelta(days=offset))] = fresh.get(str(start + timedelta(days=offset)), {'queries': 0, 'uploads': 0, 'pro_conversions': 0})
+            self.daily = {d: v for d, v in self.daily.items() if d >= str(window_start)}
+            users, pro_users, free_quota_left, exhausted = s.query(func.count(User.id), func.count(User.id).filter(User.is_pro == True), func.coalesce(func.sum(User.upload_quota).filter(User.is_pro == False), 0), func.count(User.id).filter(User.is_pro == False, User.upload_quota <= 0)).one()
+            free_users = users - pro_users
+            self.totals = {'users': users, 'pro_users': pro_users, 'doctors': s.query(func.count(Doctor.id)).scalar(), 'queries': s.query(func.count(Query.id)).scalar(),
+                           'quota_used': free_users * FREE_UPLOAD_QUOTA - free_quota_left, 'quota_total': free_users * FREE_UPLOAD_QUOTA, 'quota_exhausted': exhausted}
+            self.computed_through = today; self.refreshed_at = time.monotonic()
+        finally: s.close()
+admin_stats = AdminStats(app.config['ADMIN_STATS_TTL'], app.config['ADMIN_STATS_DAYS'])
+
+# --- Background Job Queue ---
+# Model calls run on a bounded local worker pool instead of the request thread. Jobs are persisted
+# in the `jobs` table so the browser can poll /jobs/<id> (or listen on /jobs/<id>/events) and so
+# queued work survives a restart.
+class JobError(Exception): pass
+job_executor = ThreadPoolExecutor(max_workers=app.config['MEDGEMMA_MAX_CONCURRENCY'], thread_name_prefix='medgemma-job')
+JOB_HANDLERS = {}
+def job_handler(kind, failure_message, on_failure=None):
+    # Handlers take (db session, job, payload) and return the JSON-serializable job result, if any.
+    # A handler that reads before calling the model commits first so no connection is held during
+    # the call. on_failure runs after the handler's changes are rolled back.
+    def register(func): JOB_HANDLERS[kind] = (func, failure_message, on_failure); return func
+    return register
+def fail_job(s, job, error):
+    _, _, on_failure = JOB_HANDLERS[job.kind]; job.status = 'failed'; job.error = error
+    if on_failure: on_failure(s, job, json.loads(job.payload))
+def submit_job(user_id, kind, payload):
+    job = Job(user_id=user_id, kind=kind, payload=json.dumps(payload)); db_session.add(job); db_session.commit()
+    job_executor.submit(run_job, job.id); return job
+def run_job(job_id):
+    # Objects stay loaded across commits, so the session only checks out a pooled connection while
+    # it reads or writes and gives it back before the model call.
+    s = Session(expire_on_commit=False)
+    try:
+        # Claim the job atomically so a second process resuming jobs cannot run it twice.
+        claimed = s.query(Job).filter_by(id=job_id, status='queued').update({'status': 'running', 'started_at': datetime.utcnow()}); s.commit()
+        if not claimed: return
+        job = s.get(Job, job_id); payload = json.loads(job.payload); s.commit()
+        handler, failure_message, _ = JOB_HANDLERS[job.kind]
+        try:
+            result = handler(s, job, payload); job.status = 'done'
+            if result is not None: job.result = json.dumps(result)
+        except JobError as e: s.rollback(); fail_job(s, job, str(e))
+        except Exception: s.rollback(); app.logger.exception("Job %s (%s) failed", job_id, job.kind); fail_job(s, job, failure_message)
+        job.finished_at = datetime.utcnow(); s.commit(); record_job_metrics(job, queued=True)
+    finally: s.close()
+def record_job_metrics(job, queued=False):
+    metrics.inc('jobs_total', kind=job.kind, status=job.status)
+    if queued: metrics.observe('job_wait_seconds', (job.started_at - job.created_at).total_seconds(), kind=job.kind)
+    metrics.observe('job_duration_seconds', (job.finished_at - job.started_at).total_seconds(), kind=job.kind)
+@metrics.collector('job_queue_depth', 'gauge', "Jobs waiting for or held by a worker, across all processes.")
+def job_queue_depth():
+    s = Session()
+    try: counts = dict(s.query(Job.status, func.count(Job.id)).filter(Job.status.in_(('queued', 'running'))).group_by(Job.status).all())
+    finally: s.close()
+    return {(('status', status),): counts.get(status, 0) for status in ('queued', 'running')}
+def job_stale_after(kind):
+    # A batch analyzes its documents in waves of BATCH_PARALLEL, each allowed as long as a single job.
+    if kind == 'batch_analysis': return app.config['JOB_STALE_AFTER'] * -(-app.config['BATCH_MAX_FILES'] // BATCH_PARALLEL)
+    return app.config['JOB_STALE_AFTER']
+def resume_pending_jobs():
+    s = Session()
+    try:
+        now = datetime.utcnow(); stale = now - timedelta(seconds=app.config['JOB_STALE_AFTER']); abandoned = []
+        for job in s.query(Job).filter(Job.status == 'running', Job.started_at < stale):
+            if job.started_at >= now - timedelta(seconds=job_stale_after(job.kind)): continue
+            # A streamed turn's browser is long gone and replaying it would add a reply after newer
+            # turns, so it is failed (without on_failure, which edits the transcript) instead.
+            if json.loads(job.payload).get('stream'): job.status = 'failed'; job.error = JOB_HANDLERS[job.kind][1]; job.finished_at = now; abandoned.append(job.id)
+            else: job.status = 'queued'
+        if abandoned: s.query(Conversation).filter(Conversation.pending_job_id.in_(abandoned)).update({'pending_job_id': None}, synchronize_session=False)
+        s.commit()
+        for (job_id,) in s.query(Job.id).filter_by(status='queued').order_by(Job.created_at): job_executor.submit(run_job, job_id)
+    finally: s.close()
+def job_status(s, job):
+    status = {"id": job.id, "kind": job.kind, "status": job.status, "error": job.error}
+    if job.status == 'queued': status['queue_position'] = s.query(Job).filter(Job.status == 'queued', Job.created_at < job.created_at).count() + 1
+    return status
+@job_handler('analysis', "Invalid AI response.")
+def run_analysis_job(s, job, payload):
+    response_str = get_medgemma_response(text=payload['text'], file_path=payload['file_path'], mode='standard', pages=payload.get('pages'))
+    try: error = json.loads(response_str).get('error')
+    except (json.JSONDecodeError, TypeError, AttributeError): raise JobError("Invalid AI response.")
+    if error: raise JobError(f"AI Error: {error}")
+    query = Query(user_id=job.user_id, input_type=payload['input_type'], file_path=payload['file_path'], user_text=payload['text'], medgemma_response=response_str)
+    s.add(query); s.flush(); job.query_id = query.id; job.result = response_str
+
+# --- Batch Analysis ---
+# A batch is one job whose documents are analyzed concurrently on a shared pool of
+# BATCH_PARALLEL = min(BATCH_MAX_PARALLEL, MEDGEMMA_MAX_CONCURRENCY) threads. Their model calls take the same
+# inference slots as every other job and stream, so the MEDGEMMA_MAX_CONCURRENCY cap holds across
+# all of them. The per-document answers are kept as QueryDocument rows and merged into a single
+# Query. BATCH_QUOTA_POLICY is 'per_file' (one upload per document) or 'per_batch' (one upload
+# per submission).
+BATCH_PARALLEL = min(app.config['BATCH_MAX_PARALLEL'], app.config['MEDGEMMA_MAX_CONCURRENCY'])
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_PARALLEL, thread_name_prefix='medgemma-batch')
+CONFIDENCE_LEVELS = ['low', 'medium', 'high']
+def confidence_rank(value):
+    # Ranks by the leading level word ("High - clear scan" counts as high); anything else ranks lowest.
+    match = re.match(r'\s*(low|medium|high)\b', value, re.I)
+    return CONFIDENCE_LEVELS.index(match.group(1).lower()) if match else -1
+def batch_quota_cost(file_count): return 1 if app.config['BATCH_QUOTA_POLICY'] == 'per_batch' else file_count
+def merge_analyses(analyses):
+    """Combines (document name, analysis) pairs into one analysis with the single-document keys."""
+    analyses = [(name, normalize_analysis(result)) for name, result in analyses]
+    if len(analyses) == 1: return analyses[0][1]
+    findings = {}; specialties = Counter(); next_steps = {}
+    for name, result in analyses:
+        for line in result['FINDINGS']: findings.setdefault(f"{name}: {line}")
+        specialties.update(dict.fromkeys(REVERSE_SYNONYMS.get(spec.title(), spec) for spec in result['SUGGESTED_SPECIALTIES']).keys())
+        if result.get('NEXT_STEPS'): next_steps.setdefault(str(result['NEXT_STEPS']).strip())
+    confidences = [str(r.get('CONFIDENCE') or '').strip() for _, r in analyses]
+    # Specialties suggested for more documents come first (ties keep their first-seen order), and the
+    # batch is only as confident as its least confident document.
+    return {"SUMMARY": ' '.join(f"{name}: {result.get('SUMMARY', '')}".strip() for name, result in analyses), "FINDINGS": list(findings),
+            "SUGGESTED_SPECIALTIES": [spec for spec, _ in specialties.most_common()],
+            "CONFIDENCE": min((c for c in confidences if c), key=confidence_rank, default=''), "NEXT_STEPS": ' '.join(next_steps)}
+@job_handler('batch_analysis', "Invalid AI response.")
+def run_batch_analysis_job(s, job, payload):
+    documents = payload['documents']
+    responses = list(batch_executor.map(lambda d: get_medgemma_response(text=payload['text'], file_path=d['file_path'], mode='standard', pages=d.get('pages')), documents))
+    query = Query(user_id=job.user_id, input_type='batch', user_text=payload['text']); s.add(query); s.flush(); analyses = []
+    for position, (document, response_str) in enumerate(zip(documents, responses)):
+        try: result = json.loads(response_str); error = result.get('error')
+        except (json.JSONDecodeError, TypeError, AttributeError): result, error = None, "Invalid AI response."
+        s.add(QueryDocument(query_id=query.id, position=position, name=document['name'], input_type=document['input_type'], file_path=document['file_path'], medgemma_response=None if error else response_str, error=error))
+        if not error: analyses.append((document['name'], result))
+    if not analyses: raise JobError("AI Error: none of the documents could be analyzed.")
+    query.medgemma_response = job.result = json.dumps(merge_analyses(analyses)); job.query_id = query.id
+def submit_batch_analysis(text, files, pages):
+    # Returns (job, None) or (None, (message, flash category, HTTP status)).
+    files = [f for f in files if f and f.filename]
+    if not files: return None, ("Please choose at least one file.", 'danger', 400)
+    if len(files) > app.config['BATCH_MAX_FILES']: return None, (f"Please upload at most {app.config['BATCH_MAX_FILES']} files at a time.", 'danger', 400)
+    if not all(allowed_file(f.filename) for f in files): return None, ('Invalid file type.', 'danger', 400)
+    cost = batch_quota_cost(len(files))
+    if not current_user.is_pro and current_user.upload_quota < cost: return None, ('Upload quota exceeded.', 'warning', 403)
+    documents = []
+    for f in files:
+        fpath, _ = save_upload(f); itype = 'pdf' if fpath.endswith('.pdf') else 'image'
+        documents.append({'name': secure_filename(f.filename) or os.path.basename(fpath), 'file_path': fpath, 'input_type': itype, 'pages': pages if itype == 'pdf' else None})
+    decrement_quota(current_user, cost)
+    return submit_job(current_user.id, 'batch_analysis', {'text': text, 'documents': documents}), None
 
-# --- Routes (unchanged up to symptom_checker) ---
+# --- Token Streaming ---
+# Streamed turns are recorded as jobs too, and finish through the same handler as a queued job of
+# that kind, so the conversation store is updated identically either way.
+class JSONFieldStream:
+    """Scans a JSON object as it streams in and reports text appended to its top-level string values."""
+    def __init__(self):
+        self.depth = 0; self.in_string = False; self.is_key = False; self.expect_value = False
+        self.escape = None; self.key = None; self.token = []
+    def feed(self, chunk):
+        deltas = {}
+        for c in chunk:
+            if not self.in_string:
+                if c in '{[': self.depth += 1
+                elif c in '}]': self.depth -= 1
+                elif c == ':' and self.depth == 1: self.expect_value = True
+                elif c == ',' and self.depth == 1: self.expect_value = False
+                elif c == '"' and self.depth >= 1: self.in_string = True; self.is_key = self.depth == 1 and not self.expect_value; self.token = []
+                continue
+            if self.escape is not None:
+                self.escape += c
+                if self.escape[1] == 'u' and len(self.escape) < 6: continue
+                try: c = json.loads(f'"{self.escape}"')
+                except json.JSONDecodeError: c = ''
+                self.escape = None
+            elif c == '\\': self.escape = c; continue
+            elif c == '"':
+                self.in_string = False
+                if self.is_key: self.key = ''.join(self.token)
+                elif self.depth == 1: self.expect_value = False
+                continue
+            self.token.append(c)
+            if not self.is_key and self.depth == 1: deltas[self.key] = deltas.get(self.key, '') + c
+        return deltas
+    def open_key(self):
+        """The key whose top-level string value has started but not yet closed, if any."""
+        return self.key if self.in_string and not self.is_key and self.depth == 1 else None
+def sse_event(data): return f"data: {json.dumps(data)}\n\n"
+def finish_stream_job(job_id, text):
+    # Records the streamed reply (None if the stream broke off) through the kind's handler, in a
+    # session of its own. Returns (result, error message).
+    s = Session(expire_on_commit=False); result = error = None
+    try:
+        job = s.get(Job, job_id); payload = json.loads(job.payload); s.commit()
+        handler, failure_message, _ = JOB_HANDLERS[job.kind]
+        try:
+            if text is None: raise JobError(failure_message)
+            result = handler(s, job, payload, text=text); job.result = json.dumps(result); job.status = 'done'
+        except Exception:
+            if text is not None: app.logger.exception("Streaming job %s (%s) failed", job_id, job.kind)
+            s.rollback(); error = failure_message; fail_job(s, job, failure_message)
+        job.finished_at = datetime.utcnow(); s.commit(); record_job_metrics(job)
+    finally: s.close()
+    return result, error
+def stream_job_response(job_id, relay):
+    def generate():
+        # No session is held while streaming; the job is read up front and finished afterwards.
+        s = Session()
+        try: job = s.get(Job, job_id); kind, payload = job.kind, json.loads(job.payload)
+        finally: s.close()
+        parts = []; text = None
+        try:
+            for delta in inference_client.stream_chat(payload['messages'], schema=RESPONSE_SCHEMAS.get(payload.get('schema'))):
+                parts.append(delta)
+                for item in relay(delta): yield sse_event(item)
+            text = ''.join(parts)
+        except Exception: app.logger.exception("Streaming job %s (%s) failed", job_id, kind)
+        finally: result, error = finish_stream_job(job_id, text)  # also runs when the browser goes away
+        yield sse_event({"done": True, "result": result} if error is None else {"done": True, "error": error})
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+def start_stream_job(kind, payload):
+    job = Job(user_id=current_user.id, kind=kind, status='running', started_at=datetime.utcnow(), payload=json.dumps({**payload, 'stream': True}))
+    db_session.add(job); db_session.commit(); return job
+
+# --- Conversation Store ---
+# Chat transcripts live in the database; the cookie only carries the conversation id. Each turn
+# sends the model a token-budgeted window of recent messages plus a rolling summary of everything
+# older, which a background job keeps up to date.
+GREETINGS = {'therapeutic': "Hello! I'm here to listen. How are you feeling today?",
+             'symptom': "Welcome to the Interactive Symptom Checker. To begin, please describe your main symptom (e.g., 'I have a headache')."}
+def estimate_tokens(text): return len(text or '') // 4 + 4
+def current_conversation(kind):
+    conv_id = session.get(f'{kind}_conversation_id')
+    conv = db_session.query(Conversation).filter_by(id=conv_id, user_id=current_user.id).first() if conv_id else None
+    if not conv:
+        conv = Conversation(user_id=current_user.id, kind=kind); db_session.add(conv); db_session.commit()
+        session[f'{kind}_conversation_id'] = conv.id
+    return conv
+def reset_conversation(kind):
+    conv_id = session.pop(f'{kind}_conversation_id', None)
+    if conv_id and db_session.query(Conversation).filter_by(id=conv_id, user_id=current_user.id).count():
+        db_session.query(ConversationMessage).filter_by(conversation_id=conv_id).delete()
+        db_session.query(Conversation).filter_by(id=conv_id).delete(); db_session.commit()
+def conversation_transcript(conv):
+    messages = db_session.query(ConversationMessage).filter_by(conversation_id=conv.id).order_by(ConversationMessage.id)
+    return [{"role": "assistant", "content": GREETINGS[conv.kind]}] + [{"role": m.role, "content": m.content} for m in messages]
+def conversation_busy(conv):
+    if not conv.pending_job_id: return False
+    job = db_session.get(Job, conv.pending_job_id)
+    # A stream whose client vanished before the body started never finishes its job; stop waiting on it.
+    if job and job.status == 'running' and job.started_at < datetime.utcnow() - timedelta(seconds=app.config['JOB_STALE_AFTER']): return False
+    return bool(job and job.status in ('queued', 'running'))
+def add_conversation_message(s, conv_id, role, content): s.add(ConversationMessage(conversation_id=conv_id, role=role, content=content))
+def conversation_window(conv):
+    # Newest messages that fit the token budget; the rest is covered by the summary. The window
+    # starts on a user turn so the chat template keeps strict user/assistant alternation.
+    messages = db_session.query(ConversationMessage).filter(ConversationMessage.conversation_id == conv.id, ConversationMessage.id > conv.summarized_upto).order_by(ConversationMessage.id).all()
+    budget = app.config['CHAT_PROMPT_TOKEN_BUDGET']; used = 0; start = len(messages)
+    while start > 0 and (start == len(messages) or used + estimate_tokens(messages[start - 1].content) <= budget):
+        start -= 1; used += estimate_tokens(messages[start].content)
+    while start < len(messages) - 1 and messages[start].role != 'user': start += 1
+    overflow = messages[:start]
+    if overflow and not conv.summary_job_id and sum(estimate_tokens(m.content) for m in overflow) >= app.config['CHAT_SUMMARY_TRIGGER_TOKENS']:
+        conv.summary_job_id = submit_job(conv.user_id, 'summarize', {'conversation_id': conv.id, 'upto': overflow[-1].id}).id; db_session.commit()
+    return [{"role": m.role, "content": m.content} for m in messages[start:]]
+def begin_conversation_turn(kind, user_message):
+    conv = current_conversation(kind)
+    if conversation_busy(conv): return conv, None
+    add_conversation_message(db_session, conv.id, 'user', user_message); db_session.commit()
+    return conv, conversation_window(conv)
+def attach_turn_job(conv, job): conv.pending_job_id = job.id; db_session.commit()
+def finish_conversation_turn(s, job, payload, role=None, content=None):
+    conv = s.get(Conversation, payload['conversation_id'])
+    if not conv: return
+    if content is not None: add_conversation_message(s, conv.id, role, content)
+    # Only the job the conversation is waiting on may unlock it; an older, late job must not.
+    if conv.pending_job_id == job.id: conv.pending_job_id = None
+@job_handler('chat', "I'm sorry, I'm having a connection issue.", on_failure=lambda s, job, payload: finish_conversation_turn(s, job, payload, 'assistant', "I'm sorry, I'm having a connection issue."))
+def run_chat_job(s, job, payload, text=None):
+    reply = (text if text is not None else inference_client.chat(payload['messages'])).strip()
+    finish_conversation_turn(s, job, payload, 'assistant', reply); return {"reply": reply}
+def drop_failed_symptom_turn(s, job, payload):
+    # Matches the old cookie behaviour: a failed turn leaves no trace, so the user can resend.
+    last = s.query(ConversationMessage).filter_by(conversation_id=payload['conversation_id']).order_by(ConversationMessage.id.desc()).first()
+    if last and last.role == 'user': s.delete(last)
+    finish_conversation_turn(s, job, payload)
+@job_handler('symptom', "Sorry, a server error occurred. Please try again.", on_failure=drop_failed_symptom_turn)
+def run_symptom_job(s, job, payload, text=None):
+    data = parse_symptom_response(text if text is not None else inference_client.chat(payload['messages'], schema=symptom_schema(payload['is_final'])), payload['is_final'])
+    if payload['is_final']: finish_conversation_turn(s, job, payload)
+    else: finish_conversation_turn(s, job, payload, 'assistant', data.get("question"))
+    return data
+@job_handler('summarize', "Summarization failed.", on_failure=lambda s, job, payload: s.query(Conversation).filter_by(id=payload['conversation_id']).update({'summary_job_id': None}))
+def run_summarize_job(s, job, payload):
+    conv = s.get(Conversation, payload['conversation_id'])
+    if not conv: return
+    messages = s.query(ConversationMessage).filter(ConversationMessage.conversation_id == conv.id, ConversationMessage.id > conv.summarized_upto, ConversationMessage.id <= payload['upto']).order_by(ConversationMessage.id).all()
+    transcript = '\n'.join(f"{m.role.title()}: {m.content}" for m in messages); s.commit()
+    prompt = [{"role": "system", "content": "Summarize the conversation below in under 150 words. Keep the user's feelings, symptoms, key facts and any advice already given. Reply with the summary only."},
+              {"role": "user", "content": f"Earlier summary: {conv.summary or 'None'}\n\nConversation:\n{transcript}"}]
+    conv.summary = inference_client.chat(prompt, max_tokens=300).strip(); conv.summarized_upto = payload['upto']; conv.summary_job_id = None
+# Preprocessing workers re-import the main script as __mp_main__ when the app is started with `python app.py`.
+if __name__ != '__mp_main__': resume_pending_jobs()
+
+# --- Routes ---
 @app.route('/')
 def index(): return render_template('index.html')
 @app.route('/signup', methods=['GET', 'POST'])
@@ -140,67 +993,96 @@ def dashboard():
 @login_required
 def admin_dashboard():
     if current_user.role != 'admin': flash('Access denied.', 'danger'); return redirect(url_for('dashboard'))
-    return render_template('admin_dashboard.html', users=db_session.query(User).all(), doctors=db_session.query(Doctor).all())
+    args = request.args
+    users = db_session.query(User)
+    if args.get('users_q'): users = users.filter(User.username.ilike(f"%{args['users_q']}%"))
+    if args.get('users_plan') in ('pro', 'free'): users = users.filter(User.is_pro == (args['users_plan'] == 'pro'))
+    doctors = db_session.query(Doctor)
+    if args.get('doctors_q'): doctors = doctors.filter(Doctor.name.ilike(f"%{args['doctors_q']}%"))
+    if args.get('doctors_specialty'): doctors = doctors.filter(Doctor.primary_specialty == args['doctors_specialty'])
+    return render_template('admin_dashboard.html', stats=admin_stats.snapshot(), specialties=VALID_SPECIALTIES, filters=args,
+                           users=admin_table('users', users, User.id, args), doctors=admin_table('doctors', doctors, Doctor.id, args))
 @app.route('/ai/query', methods=['GET', 'POST'])
 @login_required
 def ai_query():
     if request.method == 'POST':
         text, file = request.form.get('query_text', ''), request.files.get('file')
         fpath, itype = None, 'text'
+        try: pages = parse_page_selection(request.form.get('pages', ''), app.config['PREPROCESS_MAX_PAGES'])
+        except ValueError as e: flash(str(e), 'danger'); return redirect(request.url)
+        files = [f for f in request.files.getlist('file') if f.filename]
+        if len(files) > 1:
+            job, error = submit_batch_analysis(text, files, pages)
+            if error: flash(error[0], error[1]); return redirect(url_for('upgrade') if error[2] == 403 else request.url)
+            return redirect(url_for('query_result', job_id=job.id))
         if file and file.filename:
             if not allowed_file(file.filename): flash('Invalid file type.', 'danger'); return redirect(request.url)
             if not current_user.is_pro and current_user.upload_quota <= 0: flash('Upload quota exceeded.', 'warning'); return redirect(url_for('upgrade'))
-            fname = secure_filename(f"{uuid.uuid4()}_{file.filename}"); fpath = os.path.join(app.config['UPLOAD_FOLDER'], fname); file.save(fpath); decrement_quota(current_user)
-            itype = 'pdf' if fname.endswith('.pdf') else 'image'
+            fpath, _ = save_upload(file); decrement_quota(current_user)
+            itype = 'pdf' if fpath.endswith('.pdf') else 'image'
         elif not text: flash('Please provide text or a file for analysis.', 'danger'); return redirect(request.url)
-        response_str = get_medgemma_response(text=text, file_path=fpath, mode='standard')
-        try:
-            if json.loads(response_str).get('error'): flash(f"AI Error: {json.loads(response_str)['error']}", 'danger'); return redirect(url_for('ai_query'))
-        except (json.JSONDecodeError, TypeError): flash("Invalid AI response.", "danger"); return redirect(url_for('ai_query'))
-        session['last_query_result'] = response_str; new_query = Query(user_id=current_user.id, input_type=itype, file_path=fpath, user_text=text, medgemma_response=response_str)
-        db_session.add(new_query); db_session.commit(); return redirect(url_for('query_result'))
+        job = submit_job(current_user.id, 'analysis', {'text': text, 'file_path': fpath, 'input_type': itype, 'pages': pages if itype == 'pdf' else None})
+        return redirect(url_for('query_result', job_id=job.id))
     return render_template('ai_query.html')
-@app.route('/query/result')
+@app.route('/ai/query/batch', methods=['POST'])
+@login_required
+def ai_query_batch():
+    try: pages = parse_page_selection(request.form.get('pages', ''), app.config['PREPROCESS_MAX_PAGES'])
+    except ValueError as e: return jsonify({"error": str(e)}), 400
+    job, error = submit_batch_analysis(request.form.get('query_text', ''), request.files.getlist('files') + request.files.getlist('file'), pages)
+    if error: return jsonify({"error": error[0]}), error[2]
+    return jsonify({"job_id": job.id, "status_url": url_for('job_status_view', job_id=job.id), "events_url": url_for('job_events', job_id=job.id), "result_url": url_for('query_result', job_id=job.id)}), 202
+@app.route('/query/result/<job_id>')
 @login_required
-def query_result():
-    result_json = session.pop('last_query_result', None);
-    if not result_json: return redirect(url_for('dashboard'))
-    result_data = json.loads(result_json)
-    if isinstance(result_data.get('FINDINGS'), str): result_data['FINDINGS'] = [l.strip().lstrip('*-• ') for l in result_data['FINDINGS'].split('\n') if l.strip()]
-    if isinstance(result_data.get('SUGGESTED_SPECIALTIES'), str): result_data['SUGGESTED_SPECIALTIES'] = [s.strip() for s in result_data['SUGGESTED_SPECIALTIES'].split(',') if s.strip()]
-    doctors = find_matching_doctors(result_data.get('SUGGESTED_SPECIALTIES', []))
-    last_query = db_session.query(Query).filter_by(user_id=current_user.id).order_by(Query.created_at.desc()).first()
-    if last_query: last_query.matched_doctor_ids = json.dumps([d.id for d in doctors]); db_session.commit()
-    return render_template('query_result.html', result=result_data, doctors=doctors)
+def query_result(job_id):
+    job = db_session.query(Job).filter(Job.id == job_id, Job.user_id == current_user.id, Job.kind.in_(('analysis', 'batch_analysis'))).first()
+    if not job: abort(404)
+    if job.status in ('queued', 'running'): return render_template('query_pending.html', job=job_status(db_session, job))
+    if job.status == 'failed': flash(job.error, 'danger'); return redirect(url_for('ai_query'))
+    last_query = db_session.get(Query, job.query_id)
+    result_data = normalize_analysis(json.loads(last_query.medgemma_response))
+    near = request.args.get('near', session.get('near_location', ''))
+    if 'near' in request.args: session['near_location'] = near
+    doctors = find_matching_doctors(result_data.get('SUGGESTED_SPECIALTIES', []), near); doctor_ids = json.dumps([d.id for d in doctors])
+    if last_query.matched_doctor_ids != doctor_ids: last_query.matched_doctor_ids = doctor_ids; db_session.commit()
+    return render_template('query_result.html', result=result_data, doctors=doctors, districts=doctor_search_index().districts, near=near, documents=query_documents(last_query))
+def query_documents(query):
+    if query.input_type != 'batch': return []
+    documents = db_session.query(QueryDocument).filter_by(query_id=query.id).order_by(QueryDocument.position).all()
+    return [{'name': d.name, 'error': d.error, 'summary': json.loads(d.medgemma_response).get('SUMMARY') if d.medgemma_response else None} for d in documents]
 @app.route('/query/history/<int:query_id>')
 @login_required
 def query_history_detail(query_id):
-    query = db_session.query(Query).filter_by(id=query_id, user_id=current_user.id).first_or_404()
-    result_data = json.loads(query.medgemma_response)
-    if isinstance(result_data.get('FINDINGS'), str): result_data['FINDINGS'] = [l.strip().lstrip('*-• ') for l in result_data['FINDINGS'].split('\n') if l.strip()]
-    if isinstance(result_data.get('SUGGESTED_SPECIALTIES'), str): result_data['SUGGESTED_SPECIALTIES'] = [s.strip() for s in result_data['SUGGESTED_SPECIALTIES'].split(',') if s.strip()]
-    doctors = []
-    if query.matched_doctor_ids:
-        doctor_ids = json.loads(query.matched_doctor_ids)
-        if doctor_ids: doctors = db_session.query(Doctor).filter(Doctor.id.in_(doctor_ids)).all()
-    return render_template('history_detail.html', result=result_data, doctors=doctors, query=query)
+    query = db_session.query(Query).filter_by(id=query_id, user_id=current_user.id).first()
+    if not query: abort(404)
+    result_data = normalize_analysis(json.loads(query.medgemma_response))
+    doctors = doctor_search_index().cards_for(json.loads(query.matched_doctor_ids)) if query.matched_doctor_ids else []
+    return render_template('history_detail.html', result=result_data, doctors=doctors, query=query, documents=query_documents(query))
 @app.route('/therapeutic_chat', methods=['GET', 'POST'])
 @login_required
 def therapeutic_chat():
-    if 'chat_history' not in session: session['chat_history'] = [{"role": "assistant", "content": "Hello! I'm here to listen. How are you feeling today?"}]
     if request.method == 'POST':
         user_msg = request.form.get('message')
         if user_msg:
-            session['chat_history'].append({"role": "user", "content": user_msg})
-            history_for_api = session['chat_history'][1:]
-            ai_response_text = get_medgemma_response(mode='therapeutic', history=history_for_api)
-            ai_message = ai_response_text.strip()
-            session['chat_history'].append({"role": "assistant", "content": ai_message}); session.modified = True
+            conv, history_for_api = begin_conversation_turn('therapeutic', user_msg)
+            if history_for_api is None: flash('Please wait for the current answer.', 'warning'); return redirect(url_for('therapeutic_chat'))
+            ai_response_text = get_medgemma_response(mode='therapeutic', history=history_for_api, summary=conv.summary)
+            add_conversation_message(db_session, conv.id, 'assistant', ai_response_text.strip()); db_session.commit()
         return redirect(url_for('therapeutic_chat'))
-    return render_template('therapeutic_chat.html', chat_history=session['chat_history'])
+    return render_template('therapeutic_chat.html', chat_history=conversation_transcript(current_conversation('therapeutic')))
+@app.route('/therapeutic_chat/stream', methods=['POST'])
+@login_required
+def therapeutic_chat_stream():
+    user_msg = (request.json or {}).get('message')
+    if not user_msg: return jsonify({"error": "No message provided."}), 400
+    conv, history_for_api = begin_conversation_turn('therapeutic', user_msg)
+    if history_for_api is None: return jsonify({"error": "Please wait for the current answer."}), 409
+    job = start_stream_job('chat', {'conversation_id': conv.id, 'messages': [{"role": "system", "content": with_summary(THERAPEUTIC_SYSTEM_PROMPT, conv.summary)}] + history_for_api})
+    attach_turn_job(conv, job)
+    return stream_job_response(job.id, relay=lambda delta: [{"delta": delta}])
 @app.route('/clear_chat')
 @login_required
-def clear_chat(): session.pop('chat_history', None); return redirect(url_for('therapeutic_chat'))
+def clear_chat(): reset_conversation('therapeutic'); return redirect(url_for('therapeutic_chat'))
 @app.route('/upgrade', methods=['GET', 'POST'])
 @login_required
 def upgrade():
@@ -212,75 +1094,95 @@ def upgrade():
 @login_required
 def doctor_search():
     search_name = request.args.get('name', '').strip(); search_specialty = request.args.get('specialty', '').strip(); search_location = request.args.get('location', '').strip()
-    query = db_session.query(Doctor)
-    if search_name: query = query.filter(Doctor.name.ilike(f'%{search_name}%'))
-    if search_specialty: query = query.filter(Doctor.primary_specialty == search_specialty)
-    if search_location: query = query.filter(Doctor.location_text.ilike(f'%{search_location}%'))
-    doctors = query.order_by(Doctor.name).all()
-    return render_template('doctor_search.html', doctors=doctors, specialties=VALID_SPECIALTIES, search_values={'name': search_name, 'specialty': search_specialty, 'location': search_location})
+    cursor = decode_cursor(request.args.get('cursor', ''), (int, float), str, int)
+    doctors, next_cursor, total = doctor_search_index().search(search_name, search_specialty, search_location, cursor=cursor, limit=app.config['DOCTOR_SEARCH_PAGE_SIZE'], min_similarity=app.config['DOCTOR_SEARCH_MIN_SIMILARITY'])
+    return render_template('doctor_search.html', doctors=doctors, total=total, next_cursor=encode_cursor(next_cursor), specialties=VALID_SPECIALTIES, search_values={'name': search_name, 'specialty': search_specialty, 'location': search_location})
 @app.route('/doctor/<int:doctor_id>')
 @login_required
 def doctor_profile(doctor_id):
     doctor = db_session.query(Doctor).filter_by(id=doctor_id).first_or_404()
     return render_template('doctor_profile.html', doctor=doctor)
 
+# --- Job Status Routes ---
+@app.route('/jobs/<job_id>')
+@login_required
+def job_status_view(job_id):
+    job = db_session.query(Job).filter_by(id=job_id, user_id=current_user.id).first()
+    if not job: abort(404)
+    status = job_status(db_session, job)
+    if job.status == 'done' and job.kind in ('analysis', 'batch_analysis'): status['result_url'] = url_for('query_result', job_id=job.id)
+    if job.status == 'done' and job.kind == 'symptom': status['result'] = json.loads(job.result)
+    return jsonify(status)
+@app.route('/jobs/<job_id>/events')
+@login_required
+def job_events(job_id):
+    if not db_session.query(Job.id).filter_by(id=job_id, user_id=current_user.id).first(): abort(404)
+    def stream():
+        last = None; deadline = time.monotonic() + 300
+        while time.monotonic() < deadline:
+            # A short session per poll, so idle watchers do not each pin a pooled connection.
+            s = Session()
+            try: status = job_status(s, s.get(Job, job_id))
+            finally: s.close()
+            if status != last: yield f"data: {json.dumps(status)}\n\n"; last = status
+            if status['status'] in ('done', 'failed'): return
+            time.sleep(0.5)
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# --- Metrics Route ---
+# Disabled unless METRICS_TOKEN is set (scrapers send "Authorization: Bearer <token>"). Behind a
+# same-host reverse proxy every request comes from loopback, so trusting 127.0.0.1 without a token
+# has to be switched on explicitly with METRICS_ALLOW_LOOPBACK.
+@app.route('/metrics')
+def metrics_view():
+    token = app.config['METRICS_TOKEN']
+    if token: allowed = hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}")
+    elif app.config['METRICS_ALLOW_LOOPBACK']: allowed = request.remote_addr in ('127.0.0.1', '::1')
+    else: abort(404)
+    if not allowed: abort(403)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # --- Symptom Checker Routes ---
 @app.route('/symptom_checker')
 @login_required
 def symptom_checker():
-    session['symptom_chat_history'] = [{"role": "assistant", "content": "Welcome to the Interactive Symptom Checker. To begin, please describe your main symptom (e.g., 'I have a headache')."}]
-    return render_template('symptom_checker.html', chat_history=session['symptom_chat_history'])
+    reset_conversation('symptom')
+    return render_template('symptom_checker.html', chat_history=conversation_transcript(current_conversation('symptom')))
 
 # --- FINAL FIX: THIS IS THE CORRECTED AND ROBUST SYMPTOM CHECKER LOGIC ---
 @app.route('/symptom_checker/send', methods=['POST'])
 @login_required
 def symptom_checker_send():
-    user_message = request.json.get('message')
-    if not user_message: return jsonify({"error": "No message provided."}), 400
+    conv, payload, error = begin_symptom_turn()
+    if error: return error
+    job = submit_job(current_user.id, 'symptom', payload); attach_turn_job(conv, job)
+    return jsonify({"job_id": job.id, "status_url": url_for('job_status_view', job_id=job.id), "events_url": url_for('job_events', job_id=job.id)}), 202
 
-    if 'symptom_chat_history' not in session: session['symptom_chat_history'] = []
-    session['symptom_chat_history'].append({"role": "user", "content": user_message})
-    
-    user_message_count = sum(1 for msg in session['symptom_chat_history'] if msg['role'] == 'user')
-    is_final_turn = user_message_count >= 3
-
-    history_for_api = session['symptom_chat_history'][1:]
-
-    if is_final_turn:
-        system_prompt = f'You are a symptom analysis AI. Based on the conversation, provide a final analysis. Your response MUST be ONLY a single, valid JSON object with keys "POSSIBLE_CAUSES", "SUGGESTED_SPECIALTIES", and "NEXT_STEPS". The value for "SUGGESTED_SPECIALTIES" MUST be a single string of specialties separated by a comma, chosen ONLY from this list: {json.dumps(VALID_SPECIALTIES)}. All text values must be in clear, beginner-friendly English.'
-    else:
-        system_prompt = 'You are a symptom checker AI. Ask only ONE clarifying question. Your response MUST be ONLY a single, valid JSON object with two keys: "question" (your follow-up question) and "is_final" (which must be the boolean value false).'
-
-    api_url = urljoin(app.config['LMSTUDIO_HOST'], "v1/chat/completions")
-    headers = {"Authorization": f"Bearer {app.config['LMSTUDIO_API_KEY']}"}
-    messages = [{"role": "system", "content": system_prompt}] + history_for_api
-    payload = {"model": "medgemma-4b-it", "messages": messages, "temperature": 0.7, "max_tokens": 1500, "stream": False}
+@app.route('/symptom_checker/stream', methods=['POST'])
+@login_required
+def symptom_checker_stream():
+    conv, payload, error = begin_symptom_turn()
+    if error: return error
+    job = start_stream_job('symptom', payload); attach_turn_job(conv, job)
+    fields = JSONFieldStream()
+    return stream_job_response(job.id, relay=lambda delta: [{"field": k, "delta": v} for k, v in fields.feed(delta).items()])
 
-    try:
-        response = requests.post(api_url, headers=headers, json=payload, timeout=180); response.raise_for_status()
-        ai_content_str = response.json()['choices'][0]['message']['content']
-        
-        json_start = ai_content_str.find('{'); json_end = ai_content_str.rfind('}') + 1
-        ai_response_json_str = ai_content_str[json_start:json_end]
-        response_data = json.loads(ai_response_json_str)
+def begin_symptom_turn():
+    user_message = (request.json or {}).get('message')
+    if not user_message: return None, None, (jsonify({"error": "No message provided."}), 400)
+    conv, history_for_api = begin_conversation_turn('symptom', user_message)
+    if history_for_api is None: return None, None, (jsonify({"error": "Please wait for the current answer."}), 409)
 
-        if not is_final_turn:
-            session['symptom_chat_history'].append({"role": "assistant", "content": response_data.get("question")})
-        else:
-            # Add the 'is_final' flag for the frontend to know it's the last step
-            response_data['is_final'] = True
-        
-        session.modified = True
-        return jsonify(response_data)
+    user_message_count = db_session.query(ConversationMessage).filter_by(conversation_id=conv.id, role='user').count()
+    is_final_turn = user_message_count >= 3
 
-    except Exception as e:
-        print(f"Symptom Checker Error: {e}")
-        return jsonify({"error": "Sorry, a server error occurred. Please try again."}), 500
+    messages = [{"role": "system", "content": with_summary(symptom_checker_system_prompt(is_final_turn), conv.summary)}] + history_for_api
+    return conv, {'conversation_id': conv.id, 'messages': messages, 'is_final': is_final_turn, 'schema': symptom_schema(is_final_turn)['name']}, None
 
 @app.route('/symptom_checker/clear')
 @login_required
 def symptom_checker_clear():
-    session.pop('symptom_chat_history', None)
+    reset_conversation('symptom')
     return redirect(url_for('symptom_checker'))
 
 
@@ -0,0 +1,223 @@
+import argparse
+import glob
+import json
+import logging
+import math
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+# --- Configuration ---
+DATABASE_FILE = 'amarshashtho.db'
+SAMPLES_FOLDER = 'uploads'
+POLL_INTERVAL = 0.05
+JOB_TIMEOUT = 120
+DOCTOR_QUERIES = [{'name': 'rahman'}, {'specialty': 'Cardiologist'}, {'location': 'Dhaka'}, {'name': 'kamal', 'location': 'Gazipur'}, {'specialty': 'Neurologist', 'location': 'Chattogram'}]
+SYMPTOM_TURNS = ["I have a headache", "It is at the front of my head", "It started two days ago"]
+CHAT_MESSAGES = ["I have been feeling stressed about work lately.", "I can't sleep well at night.", "Talking about it helps a little."]
+
+# --- Mock MedGemma Server ---
+# An OpenAI-compatible /v1/chat/completions stub that answers like the prompts in app.py expect.
+# Replies are split into 4-character "tokens": the first arrives after --latency seconds and the
+# rest at --token-rate tokens/s. --malformed-rate truncates that fraction of JSON replies; the
+# app's repair calls are always answered correctly. Replies carry non-ASCII text, sent as raw UTF-8
+# the way LM Studio sends it, so decoding mistakes show up as chat errors.
+CHAT_REPLY = "That sounds hard. It’s okay to feel that way • আপনি একা নন."
+ANALYSIS_REPLY = {"SUMMARY": "The document shows mild, non-urgent changes — nothing alarming.", "FINDINGS": "Finding one\nFinding two", "SUGGESTED_SPECIALTIES": "Cardiologist, Neurologist", "CONFIDENCE": "Medium", "NEXT_STEPS": "Book a routine appointment."}
+FINAL_SYMPTOM_REPLY = {"POSSIBLE_CAUSES": "Tension headache or dehydration.", "SUGGESTED_SPECIALTIES": "Neurologist", "NEXT_STEPS": "Rest, drink water and see a doctor if it persists."}
+class MockMedGemmaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    def log_message(self, format, *args): pass
+    def do_POST(self):
+        if self.path.rstrip('/') != '/v1/chat/completions': self.send_error(404); return
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        text = self.server.reply_for(body['messages'][0]['content'])
+        tokens = [text[i:i + 4] for i in range(0, len(text), 4)]
+        time.sleep(self.server.latency)
+        if body.get('stream'):
+            self.send_response(200); self.send_header('Content-Type', 'text/event-stream'); self.send_header('Transfer-Encoding', 'chunked'); self.end_headers()
+            for token in tokens:
+                time.sleep(1 / self.server.token_rate); self.write_chunk(f"data: {json.dumps({'choices': [{'delta': {'content': token}}]}, ensure_ascii=False)}\n\n")
+            self.write_chunk("data: [DONE]\n\n"); self.wfile.write(b"0\r\n\r\n")
+        else:
+            time.sleep(len(tokens) / self.server.token_rate)
+            payload = json.dumps({"choices": [{"message": {"role": "assistant", "content": text}}], "usage": {"completion_tokens": len(tokens)}}, ensure_ascii=False).encode()
+            self.send_response(200); self.send_header('Content-Type', 'application/json'); self.send_header('Content-Length', str(len(payload))); self.end_headers(); self.wfile.write(payload)
+    def write_chunk(self, text):
+        data = text.encode(); self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n"); self.wfile.flush()
+class MockMedGemmaServer(ThreadingHTTPServer):
+    daemon_threads = True
+    def __init__(self, port, latency, token_rate, malformed_rate):
+        super().__init__(('127.0.0.1', port), MockMedGemmaHandler)
+        self.latency, self.token_rate, self.malformed_rate = latency, token_rate, malformed_rate
+    def reply_for(self, system_prompt):
+        if system_prompt.startswith('Summarize'): return "The user has been stressed about work and is sleeping poorly."
+        if system_prompt.startswith('The text below'): return json.dumps(FINAL_SYMPTOM_REPLY if 'POSSIBLE_CAUSES' in system_prompt else {"question": "How long have you had it?", "is_final": False} if '"question"' in system_prompt else ANALYSIS_REPLY)
+        if 'medical AI' in system_prompt: reply = json.dumps(ANALYSIS_REPLY, ensure_ascii=False)
+        elif 'symptom analysis' in system_prompt: reply = json.dumps(FINAL_SYMPTOM_REPLY)
+        elif 'symptom checker' in system_prompt: reply = json.dumps({"question": "How long have you had it?", "is_final": False})
+        else: return CHAT_REPLY
+        return reply[:len(reply) // 2] if random.random() < self.malformed_rate else reply
+    def handle_error(self, request, client_address):
+        # The app closes streamed responses as soon as it reads [DONE]; that is not worth a traceback.
+        if not isinstance(sys.exc_info()[1], ConnectionError): super().handle_error(request, client_address)
+    @property
+    def url(self): return f"http://127.0.0.1:{self.server_address[1]}/"
+def start_in_thread(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start(); return server
+
+# --- App Under Test ---
+def start_app(workdir, lmstudio_url):
+    # app.py reads its configuration at import time, so the environment is set up first.
+    shutil.copy(DATABASE_FILE, os.path.join(workdir, 'bench.db'))
+    os.environ.update(DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}", UPLOAD_FOLDER=os.path.join(workdir, 'uploads'),
+                      RENDER_CACHE_FOLDER=os.path.join(workdir, 'render_cache'), LMSTUDIO_HOST=lmstudio_url, LMSTUDIO_API_KEY='benchmark')
+    os.environ.setdefault('SECRET_KEY', 'benchmark'); os.environ.setdefault('ADMIN_SIGNUP_SECRET', uuid.uuid4().hex); os.makedirs(os.environ['UPLOAD_FOLDER'], exist_ok=True)
+    import app as amarshashtho
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, amarshashtho.app, threaded=True); threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+def new_user(base):
+    http = requests.Session(); username = f"bench-{uuid.uuid4().hex[:12]}"
+    http.post(f"{base}/signup", data={'username': username, 'password': 'benchmark'})
+    http.post(f"{base}/login", data={'username': username, 'password': 'benchmark'})
+    http.post(f"{base}/upgrade")  # Pro accounts have no upload quota
+    return http
+
+# --- Scenarios ---
+# Each scenario function runs one iteration for a logged-in user and returns True on success.
+def wait_for_job(http, base, job_id):
+    deadline = time.monotonic() + JOB_TIMEOUT
+    while time.monotonic() < deadline:
+        status = http.get(f"{base}/jobs/{job_id}").json()
+        if status['status'] in ('done', 'failed'): return status['status'] == 'done'
+        time.sleep(POLL_INTERVAL)
+    return False
+def read_events(response):
+    return [json.loads(line[5:]) for line in (raw.decode('utf-8') for raw in response.iter_lines()) if line.startswith('data:')]
+def ai_query(http, base, tag, sample=None):
+    # The tag keeps the text unique so every iteration misses the AI result cache.
+    data = {'query_text': f"Please review this for me ({tag})."}
+    if sample:
+        with open(sample, 'rb') as f: response = http.post(f"{base}/ai/query", data=data, files={'file': (os.path.basename(sample), f.read())}, allow_redirects=False)
+    else: response = http.post(f"{base}/ai/query", data=data, allow_redirects=False)
+    location = response.headers.get('Location', '')
+    if response.status_code != 302 or '/query/result/' not in location: return False
+    return wait_for_job(http, base, location.rsplit('/', 1)[1]) and http.get(f"{base}{location}" if location.startswith('/') else location).status_code == 200
+def doctor_search(http, base, tag):
+    return http.get(f"{base}/doctors", params=random.choice(DOCTOR_QUERIES)).status_code == 200
+def symptom_checker(http, base, tag):
+    http.get(f"{base}/symptom_checker")
+    for message in SYMPTOM_TURNS:
+        events = read_events(http.post(f"{base}/symptom_checker/stream", json={'message': message}, stream=True))
+        if not events or 'result' not in events[-1]: return False
+    return events[-1]['result'].get('is_final') is True
+def therapeutic_chat(http, base, tag):
+    events = read_events(http.post(f"{base}/therapeutic_chat/stream", json={'message': random.choice(CHAT_MESSAGES)}, stream=True))
+    return bool(events) and events[-1].get('result', {}).get('reply') == CHAT_REPLY
+def find_samples(*extensions):
+    return sorted(p for p in glob.glob(os.path.join(SAMPLES_FOLDER, '*')) if p.lower().rsplit('.', 1)[-1] in extensions)
+SCENARIOS = {
+    'ai_query_text': lambda: (ai_query, None),
+    'ai_query_image': lambda: (ai_query, find_samples('jpg', 'jpeg', 'png')),
+    'ai_query_pdf': lambda: (ai_query, find_samples('pdf')),
+    'doctors': lambda: (doctor_search, None),
+    'symptom_checker': lambda: (symptom_checker, None),
+    'therapeutic_chat': lambda: (therapeutic_chat, None),
+}
+
+# --- Runner & Report ---
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'): return int(line.split()[1]) / 1024
+    except OSError: pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+def percentile(values, p): return values[max(0, math.ceil(p / 100 * len(values)) - 1)] if values else 0.0
+def run_scenario(base, name, users, iterations):
+    func, samples = SCENARIOS[name]()
+    if samples == []: print(f"Skipping {name}: no samples in '{SAMPLES_FOLDER}/'."); return None
+    sessions = [new_user(base) for _ in range(users)]; latencies = []; errors = 0; lock = threading.Lock()
+    def user_loop(index):
+        nonlocal errors
+        for n in range(iterations):
+            args = (sessions[index], base, f"{name}-{index}-{n}-{uuid.uuid4().hex[:6]}") + ((samples[(index + n) % len(samples)],) if samples else ())
+            started = time.perf_counter()
+            try: ok = func(*args)
+            except requests.RequestException: ok = False
+            with lock:
+                latencies.append(time.perf_counter() - started)
+                if not ok: errors += 1
+    rss_before = rss_mb(); started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as pool: list(pool.map(user_loop, range(users)))
+    elapsed = time.perf_counter() - started; latencies.sort()
+    return {'scenario': name, 'iterations': len(latencies), 'errors': errors, 'rps': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 50) * 1000, 'p95_ms': percentile(latencies, 95) * 1000, 'p99_ms': percentile(latencies, 99) * 1000,
+            'rss_mb': rss_mb(), 'rss_delta_mb': rss_mb() - rss_before}
+def print_report(results):
+    print(f"\n{'scenario':<18}{'iters':>7}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'rss MB':>9}{'Δrss MB':>9}")
+    for r in results: print(f"{r['scenario']:<18}{r['iterations']:>7}{r['errors']:>8}{r['rps']:>9.2f}{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}{r['rss_mb']:>9.1f}{r['rss_delta_mb']:>9.1f}")
+def find_regressions(results, baseline, tolerance):
+    previous = {r['scenario']: r for r in baseline['results']}; regressions = []
+    for r in results:
+        base = previous.get(r['scenario'])
+        if not base: continue
+        if r['rps'] < base['rps'] * (1 - tolerance): regressions.append(f"{r['scenario']}: {r['rps']:.2f} req/s vs {base['rps']:.2f} in the baseline")
+        if r['p95_ms'] > base['p95_ms'] * (1 + tolerance): regressions.append(f"{r['scenario']}: p95 {r['p95_ms']:.1f} ms vs {base['p95_ms']:.1f} ms in the baseline")
+        if r['errors'] > base['errors']: regressions.append(f"{r['scenario']}: {r['errors']} errors vs {base['errors']} in the baseline")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test AmarShashtho against a local mock MedGemma server.")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"comma-separated subset of: {', '.join(SCENARIOS)}")
+    parser.add_argument('--users', type=int, default=4, help="concurrent virtual users per scenario")
+    parser.add_argument('--iterations', type=int, default=10, help="iterations per user per scenario")
+    parser.add_argument('--latency', type=float, default=0.2, help="mock server delay before the first token, in seconds")
+    parser.add_argument('--token-rate', type=float, default=50, help="mock server tokens per second")
+    parser.add_argument('--malformed-rate', type=float, default=0.0, help="fraction of JSON replies the mock server truncates")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline', help="compare against results saved with --json; exits 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed relative slowdown against the baseline")
+    parser.add_argument('--mock-only', action='store_true', help="only run the mock server (point LMSTUDIO_HOST at it)")
+    parser.add_argument('--port', type=int, default=0, help="mock server port (default: any free port)")
+    args = parser.parse_args()
+    unknown = set(args.scenarios.split(',')) - set(SCENARIOS)
+    if unknown: parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    mock = MockMedGemmaServer(args.port, args.latency, args.token_rate, args.malformed_rate)
+    if args.mock_only:
+        print(f"--- Mock MedGemma server listening on {mock.url} ---"); mock.serve_forever(); return
+    start_in_thread(mock)
+    print("--- AmarShashtho Benchmark ---")
+    print(f"Mock server: latency {args.latency}s, {args.token_rate} tokens/s, malformed rate {args.malformed_rate}")
+    print(f"Load: {args.users} users x {args.iterations} iterations per scenario")
+    with tempfile.TemporaryDirectory(prefix='amarshashtho-bench-') as workdir:
+        base = start_app(workdir, mock.url); results = []
+        for name in args.scenarios.split(','):
+            print(f"Running {name}...")
+            result = run_scenario(base, name, args.users, args.iterations)
+            if result: results.append(result)
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f: json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+        print(f"\nResults written to {args.json}")
+    if args.baseline:
+        with open(args.baseline) as f: regressions = find_regressions(results, json.load(f), args.tolerance)
+        for line in regressions: print(f"REGRESSION {line}")
+        if regressions: raise SystemExit(1)
+        print("\nNo regressions against the baseline.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+"""Rasterizes uploads into model-sized JPEGs. Runs in app.py's preprocessing process pool and lives
+outside app.py so pool workers can load it without importing the web app."""
+import os
+import fitz
+from PIL import Image, ImageOps
+
+def _save_jpeg(image, path, quality):
+    tmp_path = f"{path}.{os.getpid()}.tmp"; image.convert('RGB').save(tmp_path, 'JPEG', quality=quality, optimize=True); os.replace(tmp_path, path)
+def render_document(file_path, digest, cache_dir, max_side, pages, max_pages, quality):
+    # Runs in the preprocessing pool; returns the cached JPEG paths to send to the model.
+    os.makedirs(cache_dir, exist_ok=True)
+    if not file_path.lower().endswith('.pdf'):
+        out_path = os.path.join(cache_dir, f"{digest}-0-{max_side}.jpg")
+        if not os.path.exists(out_path):
+            with Image.open(file_path) as image:
+                image = ImageOps.exif_transpose(image); image.thumbnail((max_side, max_side), Image.LANCZOS); _save_jpeg(image, out_path, quality)
+        return [out_path]
+    rendered = []
+    with fitz.open(file_path) as doc:
+        for page_no in (pages if pages else range(min(max_pages, doc.page_count))):
+            if page_no >= doc.page_count: continue
+            out_path = os.path.join(cache_dir, f"{digest}-{page_no}-{max_side}.jpg")
+            if not os.path.exists(out_path):
+                page = doc.load_page(page_no)
+                # Pick the zoom (dpi / 72) that makes the longest side land on the model's input size.
+                zoom = max(0.5, min(300 / 72, max_side / max(page.rect.width, page.rect.height)))
+                pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom)); _save_jpeg(Image.frombytes('RGB', (pix.width, pix.height), pix.samples), out_path, quality)
+            rendered.append(out_path)
+    if not rendered: raise ValueError("The selected pages are not in this document.")
+    return rendered
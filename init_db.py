@@ -2,11 +2,14 @@ import sqlalchemy
 import json
 import os
 import re
+import time
+import hashlib
 
 # --- Configuration ---
 DATABASE_URL = 'sqlite:///amarshashtho.db'
 JSON_FILE_PATH = 'BD Doctor_Search.json'
 SYNONYMS_FILE_PATH = 'specialty_synonyms.json'
+BATCH_SIZE = 500
 
 # --- SQLAlchemy Setup ---
 engine = sqlalchemy.create_engine(DATABASE_URL)
@@ -23,9 +26,59 @@ doctors_table = sqlalchemy.Table('doctors', metadata,
     sqlalchemy.Column('clinic_address', sqlalchemy.Text),
     sqlalchemy.Column('profile_image', sqlalchemy.String),
     sqlalchemy.Column('rating', sqlalchemy.Float, nullable=True),
-    sqlalchemy.Column('notes', sqlalchemy.Text)
+    sqlalchemy.Column('notes', sqlalchemy.Text),
+    # Stable import key (the scrape's Title_URL) and a hash of the raw record, used to upsert
+    # in place so doctor IDs referenced from queries.matched_doctor_ids never change.
+    sqlalchemy.Column('source_url', sqlalchemy.String),
+    sqlalchemy.Column('content_hash', sqlalchemy.String(64))
 )
 
+# The web app rebuilds its in-memory doctor search index whenever this version changes.
+catalog_meta_table = sqlalchemy.Table('catalog_meta', metadata,
+    sqlalchemy.Column('name', sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column('value', sqlalchemy.String)
+)
+
+def bump_catalog_version(connection):
+    connection.execute(catalog_meta_table.delete().where(catalog_meta_table.c.name == 'doctors_version'))
+    connection.execute(catalog_meta_table.insert(), {'name': 'doctors_version', 'value': str(time.time())})
+
+def ensure_import_columns():
+    """Adds the upsert bookkeeping columns to databases created before they existed."""
+    existing = {c['name'] for c in sqlalchemy.inspect(engine).get_columns('doctors')}
+    with engine.begin() as connection:
+        for column in ('source_url', 'content_hash'):
+            if column not in existing: connection.execute(sqlalchemy.text(f"ALTER TABLE doctors ADD COLUMN {column} VARCHAR"))
+        # Rows imported by the old delete-and-reinsert loader only carry the URL inside `notes`.
+        if 'source_url' not in existing:
+            for row in connection.execute(sqlalchemy.select(doctors_table.c.id, doctors_table.c.notes)):
+                match = re.search(r"Profile URL: (\S+)", row.notes or '')
+                if match: connection.execute(doctors_table.update().where(doctors_table.c.id == row.id), {'source_url': match.group(1)})
+        connection.execute(sqlalchemy.text("CREATE INDEX IF NOT EXISTS ix_doctors_source_url ON doctors (source_url)"))
+
+def iter_json_array(path, chunk_size=64 * 1024):
+    """Yields the elements of a top-level JSON array one at a time, reading the file in chunks."""
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer, pos, eof, started = '', 0, False, False
+        while True:
+            while pos < len(buffer) and (buffer[pos].isspace() or (started and buffer[pos] == ',')): pos += 1
+            if pos < len(buffer):
+                if not started:
+                    if buffer[pos] != '[': raise ValueError(f"'{path}' does not contain a JSON array.")
+                    started = True; pos += 1; continue
+                if buffer[pos] == ']': return
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                    # A value that ends exactly at the buffer edge may be truncated; read more first.
+                    if end < len(buffer) or eof: yield item; pos = end; continue
+                except json.JSONDecodeError:
+                    if eof: raise
+            elif eof:
+                raise ValueError(f"'{path}' ended before the JSON array was closed.")
+            chunk = f.read(chunk_size); eof = not chunk
+            buffer = buffer[pos:] + chunk; pos = 0
+
 def clean_text(text):
     if not text or not isinstance(text, str): return ""
     return re.sub(r'\s+', ' ', text).strip()
@@ -49,8 +102,30 @@ def create_reverse_synonym_map(synonyms_path):
             reverse_map[synonym.strip().title()] = canonical_name
     return reverse_map
 
+def build_record(doc, reverse_synonyms):
+    raw_specialty = clean_text(doc.get('mb2', 'Others')).title()
+    
+    # --- FIX: Standardize the specialty using our map ---
+    canonical_specialty = reverse_synonyms.get(raw_specialty, "Others")
+    
+    return {
+        'name': clean_text(doc.get('Title', 'No Name Provided')),
+        'primary_specialty': canonical_specialty,
+        'specialties': json.dumps([canonical_specialty]),
+        'location_text': extract_location(doc.get('Info', '')),
+        'clinic_address': f"{clean_text(doc.get('mb0', ''))} {clean_text(doc.get('mb02', ''))}".strip(),
+        'profile_image': doc.get('Image', ''),
+        'notes': f"Qualifications: {clean_text(doc.get('aonmedteamdiscription', ''))}\nProfile URL: {doc.get('Title_URL', '')}".strip(),
+        'phone': None, 'email': None, 'rating': None
+    }
+
+def source_key(doc):
+    if doc.get('Title_URL'): return doc['Title_URL']
+    fallback = f"{clean_text(doc.get('Title', ''))}|{clean_text(doc.get('mb0', ''))}"
+    return f"urn:doctor:{hashlib.sha1(fallback.encode('utf-8')).hexdigest()}"
+
 def main():
-    print("--- AmarShashtho Doctor Database Initializer (v2) ---")
+    print("--- AmarShashtho Doctor Database Initializer (v3) ---")
     
     if not os.path.exists(JSON_FILE_PATH) or not os.path.exists(SYNONYMS_FILE_PATH):
         print(f"Error: Make sure both '{JSON_FILE_PATH}' and '{SYNONYMS_FILE_PATH}' exist.")
@@ -59,50 +134,57 @@ def main():
     # 1. Create the reverse map for standardization
     print("Loading specialty synonyms...")
     reverse_synonyms = create_reverse_synonym_map(SYNONYMS_FILE_PATH)
+    # Changing the synonym map changes every cleaned record, so it is part of each content hash.
+    with open(SYNONYMS_FILE_PATH, 'rb') as f: synonyms_hash = hashlib.sha256(f.read()).hexdigest()
 
-    # 2. Create table
+    # 2. Create tables and bring older databases up to date
     metadata.create_all(engine)
-    print("'doctors' table created or already exists.")
-
-    # 3. Read doctor data
-    with open(JSON_FILE_PATH, 'r', encoding='utf-8') as f:
-        doctor_data_list = json.load(f)
-    print(f"Loaded {len(doctor_data_list)} doctor records from JSON.")
-
-    # 4. Process and prepare data for insertion
-    doctors_to_insert = []
-    for doc in doctor_data_list:
-        raw_specialty = clean_text(doc.get('mb2', 'Others')).title()
-        
-        # --- FIX: Standardize the specialty using our map ---
-        canonical_specialty = reverse_synonyms.get(raw_specialty, "Others")
-        
-        record = {
-            'name': clean_text(doc.get('Title', 'No Name Provided')),
-            'primary_specialty': canonical_specialty,
-            'specialties': json.dumps([canonical_specialty]),
-            'location_text': extract_location(doc.get('Info', '')),
-            'clinic_address': f"{clean_text(doc.get('mb0', ''))} {clean_text(doc.get('mb02', ''))}".strip(),
-            'profile_image': doc.get('Image', ''),
-            'notes': f"Qualifications: {clean_text(doc.get('aonmedteamdiscription', ''))}\nProfile URL: {doc.get('Title_URL', '')}".strip(),
-            'phone': None, 'email': None, 'rating': None
-        }
-        doctors_to_insert.append(record)
-
-    # 5. Insert data into the database
-    if doctors_to_insert:
-        with engine.connect() as connection:
-            with connection.begin() as transaction:
-                try:
-                    print("Clearing existing data from 'doctors' table...")
-                    connection.execute(doctors_table.delete())
-                    print(f"Inserting {len(doctors_to_insert)} standardized records...")
-                    connection.execute(doctors_table.insert(), doctors_to_insert)
-                    transaction.commit()
-                    print("\n--- Success! ---")
-                    print(f"Database has been successfully populated with clean data.")
-                except Exception as e:
-                    print(f"Database error: {e}"); transaction.rollback()
+    ensure_import_columns()
+    print("'doctors' and 'catalog_meta' tables created or already exist.")
+
+    # 3. Load the key -> (id, hash) map of what is already imported
+    with engine.connect() as connection:
+        existing = {row.source_url: (row.id, row.content_hash) for row in connection.execute(sqlalchemy.select(doctors_table.c.source_url, doctors_table.c.id, doctors_table.c.content_hash)) if row.source_url}
+    print(f"Found {len(existing)} previously imported doctors.")
+
+    # 4. Stream the scrape and upsert changed records in batches
+    started = time.perf_counter(); seen = set(); inserts, updates = [], []
+    counts = {'read': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'removed': 0}
+    def flush():
+        if not inserts and not updates: return
+        with engine.begin() as connection:
+            if inserts: connection.execute(doctors_table.insert(), inserts)
+            if updates: connection.execute(doctors_table.update().where(doctors_table.c.id == sqlalchemy.bindparam('doctor_id')), updates)
+        counts['inserted'] += len(inserts); counts['updated'] += len(updates); inserts.clear(); updates.clear()
+
+    try:
+        for doc in iter_json_array(JSON_FILE_PATH):
+            counts['read'] += 1; key = source_key(doc)
+            if key in seen: continue
+            seen.add(key)
+            content_hash = hashlib.sha256((synonyms_hash + json.dumps(doc, sort_keys=True)).encode('utf-8')).hexdigest()
+            doctor_id, old_hash = existing.get(key, (None, None))
+            if old_hash == content_hash: counts['unchanged'] += 1; continue
+            record = build_record(doc, reverse_synonyms); record.update(source_url=key, content_hash=content_hash)
+            if doctor_id is None: inserts.append(record)
+            else: record['doctor_id'] = doctor_id; updates.append(record)
+            if len(inserts) + len(updates) >= BATCH_SIZE: flush()
+        flush()
+
+        # 5. Remove doctors that are no longer in the scrape and publish the new catalog version
+        with engine.begin() as connection:
+            removed = [doctor_id for key, (doctor_id, _) in existing.items() if key not in seen]
+            for i in range(0, len(removed), BATCH_SIZE):
+                connection.execute(doctors_table.delete().where(doctors_table.c.id.in_(removed[i:i + BATCH_SIZE])))
+            counts['removed'] = len(removed)
+            if counts['inserted'] or counts['updated'] or counts['removed']: bump_catalog_version(connection)
+    except (ValueError, sqlalchemy.exc.SQLAlchemyError) as e:
+        print(f"Import error: {e}"); return
+
+    elapsed = time.perf_counter() - started
+    print("\n--- Success! ---")
+    print(f"Processed {counts['read']} records in {elapsed:.2f}s ({counts['read'] / max(elapsed, 1e-9):.0f} records/s): "
+          f"{counts['inserted']} inserted, {counts['updated']} updated, {counts['unchanged']} unchanged, {counts['removed']} removed.")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
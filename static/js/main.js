@@ -1,3 +1,47 @@
+// Waits for a background AI job to finish. Uses server-sent events when available and falls back
+// to polling; always resolves with the final /jobs/<id> payload.
+function waitForJob(jobId, onUpdate) {
+    const statusUrl = `/jobs/${jobId}`;
+    const fetchStatus = () => fetch(statusUrl, { headers: { 'Accept': 'application/json' } }).then(r => r.json());
+    const isFinished = status => status.status === 'done' || status.status === 'failed';
+
+    return new Promise((resolve, reject) => {
+        function poll() {
+            fetchStatus().then(status => {
+                if (onUpdate) onUpdate(status);
+                if (isFinished(status)) resolve(status); else setTimeout(poll, 2000);
+            }).catch(reject);
+        }
+        if (!window.EventSource) { poll(); return; }
+
+        const events = new EventSource(`${statusUrl}/events`);
+        events.onmessage = function(event) {
+            const status = JSON.parse(event.data);
+            if (onUpdate) onUpdate(status);
+            if (isFinished(status)) { events.close(); fetchStatus().then(resolve, reject); }
+        };
+        events.onerror = function() { events.close(); poll(); };
+    });
+}
+
+// Reads a text/event-stream fetch response and calls onEvent with each parsed `data:` payload.
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const chunk = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            chunk.split('\n').filter(line => line.startsWith('data:')).forEach(line => onEvent(JSON.parse(line.slice(5))));
+        }
+    }
+}
+
 document.addEventListener('DOMContentLoaded', function() {
     
     // Logic for signup form admin secret field